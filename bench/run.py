@@ -0,0 +1,461 @@
+"""离线端到端基准测试
+
+在本地起一个假的视频站 (合成的 H.264/AAC 音视频流 + 播放列表, 支持 Range 和限速),
+通过 yt-dlp 插件目录 bench/yt_dlp_plugins 里的 BenchSite extractor 解析它,
+再用假的 astrbot 模块和记录 call_action 的假 bot 驱动插件的 _core_download_handler。
+
+    python bench/run.py                                # 全部场景, 结果 JSON 打到 stdout
+    python bench/run.py -s single,concurrent -u 8 -r 3 -o before.json
+    python bench/run.py --config '{"download": {"concurrent_streams": false}}' -o after.json
+
+每个场景输出: 端到端延迟 (mean/p50/p95/max), 各阶段耗时 (来自插件的 stage_seconds 直方图),
+峰值 RSS, temp 目录峰值占用 (相对场景开始时), 以及上传/错误计数, 便于两次运行直接做差。
+"""
+import argparse
+import asyncio
+import contextlib
+import importlib.util
+import json
+import logging
+import os
+import platform
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+import urllib.request
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+BASE_CONFIG = {
+    "download": {"max_size_mb": 200, "auto_delete_seconds": 5},
+    "cache": {"enabled": False},
+    "advanced": {"debug": False},
+}
+
+
+# ======= 假 astrbot =======
+def _install_fake_astrbot():
+    """只提供 main.py 用到的名字; 装饰器原样返回"""
+    class Star:
+        def __init__(self, context): self.context = context
+
+    class Context: pass
+
+    class AstrMessageEvent: pass
+
+    class _Comp:
+        def __init__(self, **kw): self.__dict__.update(kw)
+
+    def register(*a, **kw): return lambda cls: cls
+    def command(*a, **kw): return lambda fn: fn
+
+    all_mod = types.ModuleType("astrbot.api.all")
+    all_mod.__dict__.update(Star=Star, Context=Context, AstrMessageEvent=AstrMessageEvent,
+                            register=register, command=command, logger=logging.getLogger("astrbot"))
+    comp_mod = types.ModuleType("astrbot.api.message_components")
+    for name in ("Video", "Plain", "File"):
+        setattr(comp_mod, name, type(name, (_Comp,), {}))
+    api = types.ModuleType("astrbot.api")
+    api.all, api.message_components = all_mod, comp_mod
+    root = types.ModuleType("astrbot")
+    root.api = api
+    sys.modules.update({"astrbot": root, "astrbot.api": api,
+                        "astrbot.api.all": all_mod, "astrbot.api.message_components": comp_mod})
+
+
+class FakeBot:
+    """记录 call_action; fetch=True 时像真实协议端一样把文件 URL 完整拉一遍"""
+
+    def __init__(self, fetch=True):
+        self.fetch = fetch
+        self.calls = []
+
+    async def call_action(self, action, **kw):
+        t = time.monotonic()
+        nbytes = await asyncio.to_thread(self._pull, kw.get("file")) if self.fetch else 0
+        self.calls.append({"action": action, "name": kw.get("name"), "bytes": nbytes,
+                           "seconds": time.monotonic() - t})
+
+    @staticmethod
+    def _pull(url):
+        n = 0
+        with urllib.request.urlopen(url, timeout=120) as r:
+            while chunk := r.read(1 << 20): n += len(chunk)
+        return n
+
+
+class FakeEvent:
+    def __init__(self, text, bot, user_id, group_id=None):
+        self.message_str = text
+        self.bot = bot
+        self.session_id = str(group_id or user_id)
+        self.message_obj = types.SimpleNamespace(group_id=group_id, user_id=user_id)
+        self.replies = []
+
+    def plain_result(self, text): return ("plain", text)
+    def chain_result(self, chain): return ("chain", chain)
+
+
+# ======= 本地视频站 =======
+def _make_media(ffmpeg, media_dir, duration, clip_duration, vbitrate):
+    """合成 纯视频 mp4 + 纯音频 m4a 两套 (长视频 / 播放列表用的短片), 已存在则复用"""
+    os.makedirs(media_dir, exist_ok=True)
+    specs = [("v.mp4", duration, "video"), ("a.m4a", duration, "audio"),
+             ("clip_v.mp4", clip_duration, "video"), ("clip_a.m4a", clip_duration, "audio")]
+    for name, dur, kind in specs:
+        out = os.path.join(media_dir, name)
+        if os.path.exists(out): continue
+        if kind == "video":
+            src = ["-f", "lavfi", "-i", f"testsrc2=size=854x480:rate=30:duration={dur}"]
+            enc = ["-c:v", "libx264", "-preset", "ultrafast", "-b:v", vbitrate, "-pix_fmt", "yuv420p",
+                   "-movflags", "+faststart"]
+        else:
+            src = ["-f", "lavfi", "-i", f"sine=frequency=440:duration={dur}"]
+            enc = ["-c:a", "aac", "-b:a", "128k"]
+        subprocess.run([ffmpeg, "-hide_banner", "-loglevel", "error", "-y", *src, *enc, out], check=True)
+    return {name: os.path.getsize(os.path.join(media_dir, name)) for name, _, _ in specs}
+
+
+class MediaSite:
+    """/watch/<id> → /api/video/<id>; /playlist/<n>-<tag> → /api/playlist/<n>-<tag>;
+    /media/<id>/<v.mp4|a.m4a> 为实际字节 (id 以 clip- 开头时给短片)"""
+
+    def __init__(self, media_dir, sizes, duration, clip_duration, bandwidth_mb=0):
+        self.media_dir, self.sizes = media_dir, sizes
+        self.duration, self.clip_duration = duration, clip_duration
+        self.rate = bandwidth_mb * 1024 * 1024  # 每连接限速, 0 不限
+        self.served = 0
+        self._lock = threading.Lock()
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            def log_message(self, *a): pass
+            def do_GET(self): site._handle(self)
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.base = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown(); self.httpd.server_close()
+
+    def _video_meta(self, vid):
+        clip = vid.startswith("clip-")
+        v, a = ("clip_v.mp4", "clip_a.m4a") if clip else ("v.mp4", "a.m4a")
+        dur = self.clip_duration if clip else self.duration
+        return {
+            "id": vid, "title": f"bench {vid}", "duration": dur,
+            "formats": [
+                {"format_id": "v480", "url": f"/media/{vid}/{v}", "ext": "mp4", "protocol": "http",
+                 "vcodec": "avc1.64001e", "acodec": "none", "width": 854, "height": 480,
+                 "filesize": self.sizes[v], "tbr": self.sizes[v] * 8 / 1000 / dur},
+                {"format_id": "a128", "url": f"/media/{vid}/{a}", "ext": "m4a", "protocol": "http",
+                 "vcodec": "none", "acodec": "mp4a.40.2", "abr": 128,
+                 "filesize": self.sizes[a], "tbr": self.sizes[a] * 8 / 1000 / dur},
+            ],
+        }
+
+    def _json(self, h, obj):
+        body = json.dumps(obj).encode()
+        h.send_response(200)
+        h.send_header("Content-Type", "application/json")
+        h.send_header("Content-Length", str(len(body)))
+        h.end_headers()
+        h.wfile.write(body)
+
+    def _handle(self, h):
+        path = h.path.split("?", 1)[0]
+        if m := re.fullmatch(r"/api/video/([\w-]+)", path):
+            return self._json(h, self._video_meta(m.group(1)))
+        if m := re.fullmatch(r"/api/playlist/(\d+)-([\w-]+)", path):
+            n, tag = int(m.group(1)), m.group(2)
+            return self._json(h, {"title": f"bench list {tag}", "entries": [
+                {"id": f"clip-{tag}-{i}", "title": f"clip {i}", "url": f"/watch/clip-{tag}-{i}"}
+                for i in range(1, n + 1)]})
+        m = re.fullmatch(r"/media/[\w-]+/((?:clip_)?[va]\.(?:mp4|m4a))", path)
+        if not m:
+            h.send_error(404); return
+        self._send_file(h, os.path.join(self.media_dir, m.group(1)))
+
+    def _send_file(self, h, fp):
+        size = os.path.getsize(fp)
+        start, end = 0, size - 1
+        rng = re.fullmatch(r"bytes=(\d*)-(\d*)", h.headers.get("Range", ""))
+        if rng and (rng.group(1) or rng.group(2)):
+            if rng.group(1):
+                start = int(rng.group(1))
+                if rng.group(2): end = min(int(rng.group(2)), size - 1)
+            else:
+                start = max(0, size - int(rng.group(2)))
+            if start > end:
+                h.send_response(416); h.send_header("Content-Range", f"bytes */{size}")
+                h.send_header("Content-Length", "0"); h.end_headers(); return
+            h.send_response(206); h.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            h.send_response(200)
+        h.send_header("Content-Type", "video/mp4" if fp.endswith(".mp4") else "audio/mp4")
+        h.send_header("Accept-Ranges", "bytes")
+        h.send_header("Content-Length", str(end - start + 1))
+        h.end_headers()
+        left, t0, sent = end - start + 1, time.monotonic(), 0
+        with open(fp, "rb") as f:
+            f.seek(start)
+            while left > 0:
+                chunk = f.read(min(left, 256 * 1024))
+                if not chunk: break
+                try: h.wfile.write(chunk)
+                except (BrokenPipeError, ConnectionResetError): break
+                left -= len(chunk); sent += len(chunk)
+                if self.rate:
+                    ahead = sent / self.rate - (time.monotonic() - t0)
+                    if ahead > 0: time.sleep(ahead)
+        with self._lock: self.served += sent
+
+
+# ======= 采样 =======
+class Sampler:
+    """后台线程定时采样本进程 RSS 和 temp 目录占用, 记录峰值"""
+
+    def __init__(self, temp_dir, interval=0.02):
+        self.temp_dir, self.interval = temp_dir, interval
+        self._page = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+        self._stop = threading.Event()
+        self.disk_base = self.disk_peak = self._disk()
+        self.rss_start = self.rss_peak = self._rss()
+        self._t = threading.Thread(target=self._run, daemon=True)
+        self._t.start()
+
+    def _rss(self):
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * self._page
+        except OSError:
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def _disk(self):
+        total = 0
+        for root, _, files in os.walk(self.temp_dir):
+            for fn in files:
+                with contextlib.suppress(OSError):
+                    total += os.path.getsize(os.path.join(root, fn))
+        return total
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.rss_peak = max(self.rss_peak, self._rss())
+            self.disk_peak = max(self.disk_peak, self._disk())
+
+    def stop(self):
+        self._stop.set(); self._t.join()
+        return {"rss_start_mb": round(self.rss_start / 1024**2, 1),
+                "rss_peak_mb": round(self.rss_peak / 1024**2, 1),
+                "children_peak_rss_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+                "temp_peak_mb": round((self.disk_peak - self.disk_base) / 1024**2, 1)}
+
+
+# ======= 场景 =======
+def _stats(xs):
+    if not xs: return {}
+    s = sorted(xs)
+    pick = lambda q: s[min(len(s) - 1, int(round(q * (len(s) - 1))))]
+    return {"n": len(s), "mean": round(sum(s) / len(s), 3), "p50": round(pick(0.5), 3),
+            "p95": round(pick(0.95), 3), "max": round(s[-1], 3)}
+
+
+def _diff_metrics(before, after):
+    (h0, c0), (h1, c1) = before, after
+    stages = {}
+    for (name, labels), (total, n) in h1.items():
+        if name != "stage_seconds": continue
+        p_total, p_n = h0.get((name, labels), (0.0, 0))
+        if n == p_n: continue
+        stage = dict(labels).get("stage", "?")
+        stages[stage] = {"count": n - p_n, "total_s": round(total - p_total, 3),
+                         "mean_s": round((total - p_total) / (n - p_n), 3)}
+    counters = {}
+    for (name, labels), v in c1.items():
+        d = v - c0.get((name, labels), 0)
+        if d: counters[name + "".join(f"[{k}={val}]" for k, val in labels)] = round(d, 3)
+    return stages, counters
+
+
+async def _one_request(plugin, text, user_id, ctype, fetch, group_id=None):
+    bot = FakeBot(fetch)
+    ev = FakeEvent(text, bot, user_id, group_id)
+    t0 = time.monotonic()
+    url = text.split(" ", 1)[1]
+    async for r in plugin._core_download_handler(ev, url, "file", ctype):
+        ev.replies.append(r)
+    return {"latency_s": time.monotonic() - t0, "ok": bool(bot.calls),
+            "upload_bytes": sum(c["bytes"] for c in bot.calls),
+            "upload_s": sum(c["seconds"] for c in bot.calls),
+            "last_reply": ev.replies[-1][1] if ev.replies and ev.replies[-1][0] == "plain" else None}
+
+
+def _scenarios(site, args):
+    def tag(): return uuid.uuid4().hex[:8]
+    return {
+        "single": lambda: [("/download " + f"{site.base}/watch/v-{tag()}", "merged")],
+        "audio": lambda: [("/download " + f"{site.base}/watch/a-{tag()}", "audio_only")],
+        "playlist": lambda: [("/download " + f"{site.base}/playlist/{args.playlist_size}-{tag()} --y", "merged")],
+        "concurrent": lambda: (lambda shared: [
+            ("/download " + f"{site.base}/watch/c-{shared or tag()}", "merged") for _ in range(args.users)
+        ])(tag() if args.coalesce else None),
+    }
+
+
+async def _run_scenario(plugin, name, make, args):
+    sampler = Sampler(plugin.temp_dir)
+    before = plugin._metrics.snapshot()
+    t0 = time.monotonic()
+    results = []
+    for _ in range(args.repeat):
+        reqs = make()
+        results += await asyncio.gather(*(
+            _one_request(plugin, text, 10000 + i, ctype, not args.no_fetch) for i, (text, ctype) in enumerate(reqs)))
+    wall = time.monotonic() - t0
+    res = sampler.stop()
+    stages, counters = _diff_metrics(before, plugin._metrics.snapshot())
+    failed = [r["last_reply"] for r in results if not r["ok"]]
+    return {"scenario": name, "requests": len(results), "ok": len(results) - len(failed), "wall_s": round(wall, 3),
+            "latency_s": _stats([r["latency_s"] for r in results]),
+            "upload_s": _stats([r["upload_s"] for r in results if r["ok"]]),
+            "upload_mb": round(sum(r["upload_bytes"] for r in results) / 1024**2, 2),
+            "stages": stages, "counters": counters, **res,
+            "failures": failed[:5]}
+
+
+def _merge(dst, src):
+    for k, v in src.items():
+        if isinstance(v, dict) and isinstance(dst.get(k), dict): _merge(dst[k], v)
+        else: dst[k] = v
+    return dst
+
+
+def _load_plugin(workdir):
+    """main.py 复制到工作目录里加载, 插件的 temp/ 因此也落在工作目录, 不碰仓库"""
+    pdir = os.path.join(workdir, "plugin")
+    os.makedirs(pdir, exist_ok=True)
+    shutil.copy(os.path.join(REPO_DIR, "main.py"), pdir)
+    spec = importlib.util.spec_from_file_location("bench_plugin_main", os.path.join(pdir, "main.py"))
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+
+async def _amain(args):
+    workdir = args.workdir or tempfile.mkdtemp(prefix="ytdlp-bench-")
+    _install_fake_astrbot()
+    sys.path.insert(0, BENCH_DIR)  # yt_dlp_plugins/extractor/benchsite.py
+    import imageio_ffmpeg
+    import yt_dlp
+    with contextlib.suppress(ImportError):
+        from yt_dlp.plugins import load_all_plugins
+        load_all_plugins()
+    # 下载阶段 ffmpeg_location=None, 合并靠 PATH 上的 ffmpeg
+    ffmpeg = imageio_ffmpeg.get_ffmpeg_exe()
+    bindir = os.path.join(workdir, "bin")
+    os.makedirs(bindir, exist_ok=True)
+    with contextlib.suppress(FileExistsError):
+        os.symlink(ffmpeg, os.path.join(bindir, "ffmpeg"))
+    os.environ["PATH"] = bindir + os.pathsep + os.environ.get("PATH", "")
+
+    media_dir = os.path.join(workdir, "media")
+    sizes = _make_media(ffmpeg, media_dir, args.duration, args.clip_duration, args.vbitrate)
+    site = MediaSite(media_dir, sizes, args.duration, args.clip_duration, args.bandwidth)
+
+    mod = _load_plugin(workdir)
+    config = _merge(json.loads(json.dumps(BASE_CONFIG)), args.config)
+    t = time.monotonic()
+    plugin = mod.YtDlpPlugin(None, config)
+    init_s = time.monotonic() - t
+    await plugin._ensure_ready()
+    ready_s = time.monotonic() - t
+
+    async def _no_update(*a, **kw): return False, "bench: 离线运行, 不更新"
+    plugin._try_update_ytdlp = _no_update
+
+    report = {
+        "meta": {"time": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "git": _git_rev(),
+                 "python": platform.python_version(), "yt_dlp": yt_dlp.version.__version__,
+                 "platform": platform.platform(), "config": config, "init_s": round(init_s, 3),
+                 "ready_s": round(ready_s, 3),
+                 "media_mb": {k: round(v / 1024**2, 2) for k, v in sizes.items()},
+                 "args": {k: v for k, v in vars(args).items() if k not in ("config", "out")}},
+        "scenarios": [],
+    }
+    table = _scenarios(site, args)
+    try:
+        for name in args.scenarios:
+            logging.info(f"场景 {name} ...")
+            r = await _run_scenario(plugin, name, table[name], args)
+            logging.info(f"场景 {name}: ok={r['ok']}/{r['requests']} p50={r['latency_s'].get('p50')}s")
+            report["scenarios"].append(r)
+    finally:
+        report["meta"]["site_served_mb"] = round(site.served / 1024**2, 2)
+        # 插件的延迟清理任务不等了, 工作目录整体删掉
+        for task in asyncio.all_tasks():
+            if task is not asyncio.current_task(): task.cancel()
+        await plugin.terminate()
+        site.close()
+        if not args.keep and not args.workdir: shutil.rmtree(workdir, ignore_errors=True)
+    return report
+
+
+def _git_rev():
+    try:
+        return subprocess.run(["git", "-C", REPO_DIR, "rev-parse", "--short", "HEAD"],
+                              capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def main():
+    ap = argparse.ArgumentParser(description="yt-dlp 插件离线基准测试")
+    ap.add_argument("-s", "--scenarios", default="single,audio,playlist,concurrent",
+                    type=lambda s: [x.strip() for x in s.split(",") if x.strip()])
+    ap.add_argument("-u", "--users", type=int, default=4, help="concurrent 场景的并发用户数")
+    ap.add_argument("--coalesce", action="store_true", help="concurrent 场景所有用户请求同一个视频")
+    ap.add_argument("-r", "--repeat", type=int, default=1, help="每个场景重复次数")
+    ap.add_argument("--duration", type=int, default=30, help="单视频时长(秒)")
+    ap.add_argument("--clip-duration", type=int, default=3, help="播放列表条目时长(秒)")
+    ap.add_argument("--playlist-size", type=int, default=30)
+    ap.add_argument("--vbitrate", default="2M", help="合成视频码率")
+    ap.add_argument("--bandwidth", type=float, default=0, help="本地站点每连接限速 MB/s, 0 不限")
+    ap.add_argument("--no-fetch", action="store_true", help="假 bot 不回拉文件 URL")
+    ap.add_argument("--config", type=lambda s: json.load(open(s)) if os.path.isfile(s) else json.loads(s),
+                    default={}, help="覆盖插件配置 (JSON 字符串或文件)")
+    ap.add_argument("--workdir", help="工作目录 (指定时保留, 合成媒体可复用)")
+    ap.add_argument("--keep", action="store_true", help="保留临时工作目录")
+    ap.add_argument("-o", "--out", help="结果 JSON 文件, 默认 stdout")
+    ap.add_argument("-v", "--verbose", action="store_true")
+    args = ap.parse_args()
+    bad = set(args.scenarios) - {"single", "audio", "playlist", "concurrent"}
+    if bad: ap.error(f"未知场景: {', '.join(sorted(bad))}")
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format="%(asctime)s %(levelname)s %(message)s", stream=sys.stderr)
+    if not args.verbose: logging.getLogger("astrbot_plugin_yt_dlp").setLevel(logging.ERROR)
+    # yt-dlp 的进度条写 stdout, 跑的时候挪到 stderr, stdout 只留结果 JSON
+    with contextlib.redirect_stdout(sys.stderr):
+        report = asyncio.run(_amain(args))
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f: f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
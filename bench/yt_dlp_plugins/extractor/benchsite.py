@@ -0,0 +1,25 @@
+"""基准测试用的本地站点 extractor: 解析 bench/run.py 起的本地 HTTP 服务, 不访问外网"""
+from yt_dlp.extractor.common import InfoExtractor
+
+
+class BenchSiteIE(InfoExtractor):
+    IE_NAME = 'benchsite'
+    _VALID_URL = r'(?P<base>https?://(?:127\.0\.0\.1|localhost):\d+)/watch/(?P<id>[\w-]+)'
+
+    def _real_extract(self, url):
+        base, video_id = self._match_valid_url(url).group('base', 'id')
+        meta = self._download_json(f'{base}/api/video/{video_id}', video_id)
+        for f in meta['formats']:
+            f['url'] = base + f['url']
+        return meta
+
+
+class BenchSitePlaylistIE(InfoExtractor):
+    IE_NAME = 'benchsite:playlist'
+    _VALID_URL = r'(?P<base>https?://(?:127\.0\.0\.1|localhost):\d+)/playlist/(?P<id>[\w-]+)'
+
+    def _real_extract(self, url):
+        base, list_id = self._match_valid_url(url).group('base', 'id')
+        meta = self._download_json(f'{base}/api/playlist/{list_id}', list_id)
+        entries = [self.url_result(base + e['url'], BenchSiteIE, e['id'], e['title']) for e in meta['entries']]
+        return self.playlist_result(entries, list_id, meta['title'])
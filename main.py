@@ -1,30 +1,47 @@
 import asyncio
+import collections
+import contextlib
+import copy
 import logging
 import os
 import time
-import yt_dlp
 import glob
+import queue
+import random
+import hashlib
+import importlib
+import importlib.metadata
+import json
 import re
 import subprocess
 import sys
-import imageio_ffmpeg
 import shutil
 import zipfile
 import socket
+import struct
 import threading
-from http.server import SimpleHTTPRequestHandler, HTTPServer
+import itertools
+import mimetypes
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from astrbot.api.all import *
 from astrbot.api.message_components import Video, Plain, File
 
+yt_dlp = None  # 导入较慢, 由后台预热线程 (或热更新) 赋值, 见 _load_ytdlp
+
 @register("yt_dlp_plugin", "YourName", "全能视频下载助手", "3.5.5-Cookie")
 class YtDlpPlugin(Star):
     def __init__(self, context: Context, config: dict, *args, **kwargs):
         super().__init__(context)
+        t_init = time.monotonic()
         self.logger = logging.getLogger("astrbot_plugin_yt_dlp")
         self.config = config
 
         self.debug_mode = self.config.get("advanced", {}).get("debug", False)
-        self._debug_buffer = []
+        self._debug_buffer = collections.deque(maxlen=500)  # 只留最近的, 防止调试模式下无限增长
+        self._metrics = _Metrics()
 
         self.logger.info("🔥 Cookie支持版 (v3.5.5)")
         self._dbg("初始化", f"debug={self.debug_mode}, keys={list(self.config.keys())}")
@@ -34,18 +51,43 @@ class YtDlpPlugin(Star):
         os.makedirs(self.temp_dir, exist_ok=True)
         self._dbg("初始化", f"temp_dir={self.temp_dir}")
 
-        try:
-            self.ffmpeg_exe = imageio_ffmpeg.get_ffmpeg_exe()
-        except:
-            self.ffmpeg_exe = "ffmpeg"
-        self._dbg("初始化", f"ffmpeg={self.ffmpeg_exe}")
-
+        self.ffmpeg_exe = "ffmpeg"  # 预热时换成 imageio-ffmpeg 自带的
         self.proxy_enabled = self.config.get("proxy", {}).get("enabled", False)
         self.proxy_url = self.config.get("proxy", {}).get("url", "")
         self.max_quality = self.config.get("download", {}).get("max_quality", "最高画质")
         self.max_size_mb = self.config.get("download", {}).get("max_size_mb", 100)
         self.delete_seconds = self.config.get("download", {}).get("auto_delete_seconds", 60)
         self.prefer_h264 = self.config.get("download", {}).get("prefer_h264", True)
+        self.concurrent_streams = self.config.get("download", {}).get("concurrent_streams", True)
+        self.playlist_parallel = max(1, self.config.get("download", {}).get("playlist_parallel", 3))
+        self.stream_archive = self.config.get("download", {}).get("stream_archive", True)
+        self.progressive = self.config.get("download", {}).get("progressive", False)
+        self.adaptive_tuning = self.config.get("download", {}).get("adaptive_tuning", True)
+        self.progress_interval = self.config.get("download", {}).get("progress_interval", 10)
+
+        # ---- 超限转码 ----
+        tc = self.config.get("transcode", {})
+        self.transcode_enabled = tc.get("enabled", False)
+        self.transcode_preset = tc.get("preset", "veryfast")
+        self.transcode_nice = tc.get("nice", 10)
+
+        # ---- 成品缓存 ----
+        cache_cfg = self.config.get("cache", {})
+        self.cache_enabled = cache_cfg.get("enabled", True)
+        self._cache = _ResultCache(os.path.join(self.temp_dir, "cache"),
+                                   cache_cfg.get("max_mb", 1024), self.logger)
+
+        # ---- 按站点学习的下载参数 ----
+        self._tuner = _Tuner(os.path.join(self.temp_dir, "tuner.json"), self.logger)
+
+        # ---- 临时文件清理: 持久化清单 + 周期清扫, 启动时先对一次账 ----
+        jan = self.config.get("janitor", {})
+        self.janitor_interval = max(5, jan.get("interval_seconds", 30))
+        self._janitor = _Janitor(self.temp_dir, jan.get("high_watermark_mb", 2048),
+                                 max(60, jan.get("orphan_grace_minutes", 60) * 60), self.logger,
+                                 skip={os.path.relpath(self._cache.root, self.temp_dir), "tuner.json", "tuner.json.tmp"})
+        self._janitor_task = None
+        self._start_janitor()
 
         # ---- Cookie ----
         raw_cookie = self.config.get("youtube", {}).get("cookies_path", "").strip()
@@ -55,14 +97,135 @@ class YtDlpPlugin(Star):
 
         self._dbg("初始化",
             f"proxy={self.proxy_enabled}({self.proxy_url}) quality={self.max_quality} "
-            f"size={self.max_size_mb}MB h264={self.prefer_h264} "
-            f"cookie={'✓' if self.cookies_path else '✗'}")
+            f"size={self.max_size_mb}MB h264={self.prefer_h264} concurrent={self.concurrent_streams} "
+            f"cookie={'✓' if self.cookies_path else '✗'} "
+            f"cache={self.cache_enabled}({self._cache.budget // 1024**2}MB, {len(self._cache.entries)}条)")
+
+        self._inflight = {}  # (归一化URL, ctype, confirmed) -> _Job
+        self._routes = {}  # 文件服务的动态内容: URL 路径 -> fn(handler, head)
+        if self.config.get("advanced", {}).get("metrics", True):
+            self._routes["/metrics"] = self._metrics.serve
+
+        # ---- 自动更新: 单飞 + 冷却 ----
+        self.update_cooldown = max(60, self.config.get("advanced", {}).get("update_cooldown_minutes", 30) * 60)
+        self._update_task = None
+        self._update_next = 0.0
+        self._update_failures = 0
+
+        # ---- 调度: 解析 / 下载 / ffmpeg / 打包 各用独立的有界线程池 ----
+        sched = self.config.get("scheduler", {})
+        # 下载线程按最坏情况 (每个任务都是播放列表, 单视频音视频并发算 2) 配足, 配置值只能往上调
+        net_workers = max(sched.get("net_workers", 8), sched.get("max_jobs", 3) * max(2, self.playlist_parallel))
+        self._net_pool = ThreadPoolExecutor(net_workers, "ytdlp-net")
+        # 解析在拿到调度名额之前就要跑, 不能排在长时间的下载后面, 否则新请求连排队位置都拿不到
+        self._parse_pool = ThreadPoolExecutor(max(1, sched.get("parse_workers", 4)), "ytdlp-parse")
+        self._cpu_pool = ThreadPoolExecutor(max(1, sched.get("cpu_workers", 2)), "ytdlp-ffmpeg")
+        # URL 归一化只要几毫秒, 但不能排在合并/转码后面, 否则新请求连排队提示都收不到
+        self._key_pool = ThreadPoolExecutor(2, "ytdlp-key")
+        # 转码一跑就是几分钟, 单独一个池, 不让 copy 合并排在它后面
+        self._transcode_pool = ThreadPoolExecutor(
+            max(1, self.config.get("transcode", {}).get("workers", 1)), "ytdlp-transcode")
+        # 播放列表打包线程会贯穿整个下载过程, 留一个给 pip 等零碎任务
+        self._pack_pool = ThreadPoolExecutor(sched.get("max_jobs", 3) + 1, "ytdlp-pack")
+        self._sched = _Scheduler(sched.get("max_jobs", 3), sched.get("per_chat", 1), sched.get("max_queue", 20))
+
+        # ---- YoutubeDL 实例池 ----
+        self._ydl_pool = _YdlPool(self.cookies_path, net_workers)
+
+        m = self._metrics
+        m.gauge_fn("queue_depth", lambda: self._sched.depth)
+        m.gauge_fn("jobs_running", lambda: self._sched.running)
+        m.gauge_fn("jobs_inflight", lambda: len(self._inflight))
+        m.gauge_fn("cache_hits_total", lambda: self._cache.hits)
+        m.gauge_fn("cache_misses_total", lambda: self._cache.misses)
+        m.gauge_fn("cache_hit_ratio", lambda: self._cache.hits / max(1, self._cache.hits + self._cache.misses))
+        m.gauge_fn("ydl_pool_created_total", lambda: self._ydl_pool.created)
+        m.gauge_fn("ydl_pool_reused_total", lambda: self._ydl_pool.reused)
+        self._dbg("初始化", f"调度: jobs={self._sched.max_jobs} per_chat={self._sched.per_chat} "
+                  f"queue={self._sched.max_queue} net={net_workers}")
+
+        # ---- 慢的部分 (文件服务 / 本机 IP / ffmpeg / yt-dlp 导入 / 启动对账) 放到后台预热 ----
+        self.server_ip, self.server_port = "127.0.0.1", 0
+        self._httpd = None
+        self._ready = threading.Event()
+        threading.Thread(target=self._warm_up, name="ytdlp-warmup", daemon=True).start()
+        cost = time.monotonic() - t_init
+        self._metrics.set("startup_seconds", cost, phase="init")
+        self.logger.info(f"插件初始化 {cost * 1000:.0f}ms, 后台预热中")
+
+    # ======= 启动预热 =======
+    def _warm_up(self):
+        t0, steps = time.monotonic(), []
+        def _step(name, fn):
+            t = time.monotonic()
+            try: fn()
+            except Exception as e: self.logger.error(f"预热 {name} 失败: {type(e).__name__}: {e}")
+            steps.append(f"{name} {(time.monotonic() - t) * 1000:.0f}ms")
+        try:
+            _step("http", self._start_http_server)
+            _step("ip", lambda: setattr(self, "server_ip", self._get_local_ip()))
+            _step("ffmpeg", self._find_ffmpeg)
+            _step("清理", self._reconcile_temp)  # 必须在第一个任务写文件之前
+            _step("yt-dlp", self._load_ytdlp)
+        finally:
+            self._ready.set()
+        cost = time.monotonic() - t0
+        self._metrics.set("startup_seconds", cost, phase="warmup")
+        self.logger.info(f"预热完成 {cost * 1000:.0f}ms ({', '.join(steps)}) "
+                         f"HTTP: http://{self.server_ip}:{self.server_port}")
+
+    def _find_ffmpeg(self):
+        try:
+            import imageio_ffmpeg
+            self.ffmpeg_exe = imageio_ffmpeg.get_ffmpeg_exe()
+        except Exception:
+            self.ffmpeg_exe = "ffmpeg"
+        self._dbg("初始化", f"ffmpeg={self.ffmpeg_exe}")
+
+    def _reconcile_temp(self):
+        freed = self._janitor.sweep(startup=True)
+        if self._janitor.removed:
+            self.logger.info(f"启动清理: 删除 {self._janitor.removed} 项残留, 释放 {freed / 1024**2:.1f}MB")
+
+    def _load_ytdlp(self):
+        """导入 yt_dlp 并预先加载 extractor 表 (_canonical_key 要遍历)"""
+        global yt_dlp
+        if yt_dlp is None: yt_dlp = importlib.import_module("yt_dlp")
+        yt_dlp.extractor.gen_extractor_classes()
+        self._dbg("初始化", f"yt-dlp {yt_dlp.version.__version__}")
+
+    async def _ensure_ready(self):
+        """命令入口调用; 预热通常在第一条命令到达前就已完成"""
+        if self._ready.is_set(): return
+        t = time.monotonic()
+        await asyncio.get_running_loop().run_in_executor(None, self._ready.wait)
+        self._dbg("初始化", f"等待预热 {time.monotonic() - t:.2f}s")
+        if yt_dlp is None: self._load_ytdlp()  # 预热时导入失败, 这里再试一次并把异常抛给调用方
+
+    # ======= 临时文件清理 =======
+    def _start_janitor(self):
+        if self._janitor_task and not self._janitor_task.done(): return
+        try: self._janitor_task = asyncio.get_running_loop().create_task(self._janitor_loop())
+        except RuntimeError: pass  # 构造时还没有事件循环, 首个请求时再启动
+
+    async def _janitor_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.janitor_interval)
+            try: await loop.run_in_executor(self._pack_pool, self._janitor.sweep)
+            except Exception as e: self.logger.warning(f"清理失败: {e}")
 
-        self.server_port = 0
-        self.server_ip = self._get_local_ip()
-        self._start_http_server()
-        self.logger.info(f"HTTP: http://{self.server_ip}:{self.server_port}")
-        self._dbg("初始化", f"server=:{self.server_port}")
+    def _retire(self, res):
+        """成品交付完毕, 登记到清理清单; 进了缓存的成品由 LRU 淘汰, 这里不管"""
+        ttl = 120 if res['is_playlist'] else self.delete_seconds + 30
+        files = res['temp_files'] + ([] if res['cached'] else [res['path']])
+        route, g, arc = res.get('route'), res.get('growing'), res.get('archive')
+        busy = None
+        if g: busy = lambda: not g.done.is_set()
+        elif arc: busy = lambda: arc.active > 0  # 慢客户端还在拉压缩包, 目录不能删
+        self._janitor.track(files, ttl,
+                            on_drop=(lambda: self._routes.pop(route, None)) if route else None,
+                            busy=busy)
 
     # ======= Debug =======
     def _dbg(self, step, msg):
@@ -70,10 +233,9 @@ class YtDlpPlugin(Star):
             self.logger.info(f"[DEBUG][{step}] {msg}")
             self._debug_buffer.append(f"[{step}] {msg}")
 
-    def _dbg_chat(self, event, msg):
+    def _dbg_emit(self, job, msg):
         if self.debug_mode:
-            return event.plain_result(f"🔍 {msg}")
-        return None
+            job.emit(f"🔍 {msg}")
 
     # ======= 基础工具 =======
     def _get_local_ip(self):
@@ -87,21 +249,28 @@ class YtDlpPlugin(Star):
             return "127.0.0.1"
 
     def _start_http_server(self):
-        class H(SimpleHTTPRequestHandler):
-            def __init__(s, *a, **kw):
-                super().__init__(*a, directory=self.temp_dir, **kw)
-            def log_message(self, *a): pass
-        def _run():
-            srv = HTTPServer(('0.0.0.0', 0), H)
-            self.server_port = srv.server_port
-            srv.serve_forever()
-        threading.Thread(target=_run, daemon=True).start()
-        time.sleep(0.5)
+        # 同步 bind, 端口立即可知, 不用再 sleep 等线程
+        handler = type("H", (_FileHandler,), {"root": self.temp_dir, "routes": self._routes})
+        self._httpd = ThreadingHTTPServer(('0.0.0.0', 0), handler)
+        self._httpd.daemon_threads = True
+        self.server_port = self._httpd.server_port
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
 
     def _sanitize_filename(self, name):
         if not name: return "video"
         return re.sub(r'[\\/*?:"<>|]', '_', name).replace('\n',' ').replace('\r','')[:100].strip()
 
+    def _remove_partials(self, tmpl):
+        """按输出模板前缀删除残留文件 (含 .part / .ytdl 分片)"""
+        prefix = tmpl.split('%(')[0]
+        for f in glob.glob(glob.escape(prefix) + "*"):
+            try: os.remove(f)
+            except OSError: pass
+
+    def _file_url(self, path):
+        rel = os.path.relpath(path, self.temp_dir).replace(os.sep, "/")
+        return f"http://{self.server_ip}:{self.server_port}/{urllib.parse.quote(rel)}"
+
     def _format_size(self, b):
         if b is None: return "未知"
         if b<1024: return f"{b} B"
@@ -109,80 +278,296 @@ class YtDlpPlugin(Star):
         if b<1024**3: return f"{b/1024**2:.2f} MB"
         return f"{b/1024**3:.2f} GB"
 
-    # ======= 注入 proxy + cookie 到 opts =======
+    # ======= 注入 proxy 到 opts (cookie 由 _YdlPool 统一挂载) =======
     def _inject(self, opts):
         if self.proxy_enabled:
             opts["proxy"] = self.proxy_url
-        if self.cookies_path:
-            opts["cookiefile"] = self.cookies_path
         return opts
 
     # ======= 自动更新 (PEP 668 兼容) =======
     async def _try_update_ytdlp(self):
+        """同一时间只跑一次 pip, 并发失败的请求共享同一次结果; 冷却期内不再触发。
+        返回 (是否换了新版本并已热加载, 日志)"""
+        if self._update_task is None:
+            wait = self._update_next - time.monotonic()
+            if wait > 0:
+                self._dbg("更新", f"冷却中, 还剩 {wait:.0f}s")
+                return False, f"冷却中, {int(wait)}s 后才会再次尝试"
+            self._update_task = asyncio.ensure_future(self._run_update())
+            self._update_task.add_done_callback(self._on_update_done)
+        else:
+            self._dbg("更新", "已有更新在进行, 等待其结果")
+        # shield: 某个等待者被取消不影响其他等待者和 pip 本身
+        return await asyncio.shield(self._update_task)
+
+    def _on_update_done(self, task):
+        changed = not task.cancelled() and task.exception() is None and task.result()[0]
+        if changed:
+            self._update_failures = 0
+            cooldown = self.update_cooldown
+        else:
+            # 没换到新版本说明更新救不了这次的错误, 指数退避, 最长 12 小时
+            self._update_failures += 1
+            cooldown = min(self.update_cooldown * 2 ** (self._update_failures - 1), 12 * 3600)
+        self._update_next = time.monotonic() + cooldown
+        self._update_task = None
+        self._dbg("更新", f"changed={changed} 下次最早 {cooldown:.0f}s 后")
+
+    def _ytdlp_version(self):
+        try: return importlib.metadata.version("yt-dlp")
+        except importlib.metadata.PackageNotFoundError: return None
+
+    def _reload_ytdlp(self):
+        """pip 装好新版本后在进程内重新 import, 让重试直接用上新的 extractor"""
+        global yt_dlp
+        for name in [m for m in sys.modules if m == "yt_dlp" or m.startswith("yt_dlp.")]:
+            del sys.modules[name]
+        importlib.invalidate_caches()
+        yt_dlp = importlib.import_module("yt_dlp")
+        self._ydl_pool.clear()
+        self.logger.info(f"yt-dlp 已热加载: {yt_dlp.version.__version__}")
+
+    async def _run_update(self):
         """三级回退：stable → --break-system-packages → nightly (--pre)"""
         self.logger.info("尝试自动更新 yt-dlp...")
-        def _run():
-            try:
-                def _pip(args, desc):
-                    self._dbg("更新", f"尝试: {desc}")
-                    r = subprocess.run(args, capture_output=True, text=True)
-                    out = (r.stdout or "") + (r.stderr or "")
-                    self._dbg("更新", f"{desc} -> {out[-200:]}")
-                    installed = "Successfully installed" in (r.stdout or "")
-                    satisfied = "Requirement already satisfied" in (r.stdout or "")
-                    return r, installed, satisfied
-
-                py = [sys.executable, "-m", "pip", "install", "-U"]
-
-                # 第1步: stable
-                r, installed, satisfied = _pip(py + ["yt-dlp"], "stable")
-                if installed:
-                    return True, r.stdout
+        before = self._ytdlp_version()
+        ok, log = await asyncio.get_running_loop().run_in_executor(self._pack_pool, self._pip_update)
+        after = self._ytdlp_version()
+        self._dbg("更新", f"ok={ok} {before} -> {after}")
+        if not ok or before == after:
+            return False, log
+        try:
+            self._reload_ytdlp()
+        except Exception as e:
+            self.logger.error(f"yt-dlp 热加载失败, 需重启生效: {e}")
+            return False, str(e)
+        return True, log
 
-                # 第2步: PEP 668
-                if "externally-managed" in (r.stdout or "") + (r.stderr or ""):
-                    r, installed, satisfied = _pip(
-                        py + ["--break-system-packages", "yt-dlp"], "break-system")
-                    if installed:
-                        return True, r.stdout
+    def _pip_update(self):
+        try:
+            def _pip(args, desc):
+                self._dbg("更新", f"尝试: {desc}")
+                r = subprocess.run(args, capture_output=True, text=True)
+                out = (r.stdout or "") + (r.stderr or "")
+                self._dbg("更新", f"{desc} -> {out[-200:]}")
+                installed = "Successfully installed" in (r.stdout or "")
+                satisfied = "Requirement already satisfied" in (r.stdout or "")
+                return r, installed, satisfied
+
+            py = [sys.executable, "-m", "pip", "install", "-U"]
 
-                # 第3步: nightly (总是尝试, 因为 stable 可能没修已知bug)
+            # 第1步: stable
+            r, installed, satisfied = _pip(py + ["yt-dlp"], "stable")
+            if installed:
+                return True, r.stdout
+
+            # 第2步: PEP 668
+            if "externally-managed" in (r.stdout or "") + (r.stderr or ""):
                 r, installed, satisfied = _pip(
-                    py + ["--pre", "--break-system-packages", "yt-dlp[default]"], "nightly")
-                if installed or satisfied:
-                    return True, r.stdout or "nightly OK"
+                    py + ["--break-system-packages", "yt-dlp"], "break-system")
+                if installed:
+                    return True, r.stdout
+
+            # 第3步: nightly (总是尝试, 因为 stable 可能没修已知bug)
+            r, installed, satisfied = _pip(
+                py + ["--pre", "--break-system-packages", "yt-dlp[default]"], "nightly")
+            if installed or satisfied:
+                return True, r.stdout or "nightly OK"
 
-                # 如果 stable already satisfied 且 nightly 也 satisfied → 已是最新
-                if satisfied:
-                    return True, r.stdout or "已是最新"
+            # 如果 stable already satisfied 且 nightly 也 satisfied → 已是最新
+            if satisfied:
+                return True, r.stdout or "已是最新"
 
-                return False, r.stderr or r.stdout or "未知错误"
-            except Exception as e:
-                return False, str(e)
-        return await asyncio.get_running_loop().run_in_executor(None, _run)
+            return False, r.stderr or r.stdout or "未知错误"
+        except Exception as e:
+            return False, str(e)
 
     # ======= FFmpeg 合并 =======
     async def _manual_merge(self, v, a, out):
         self._dbg("合并", f"{os.path.basename(v)} + {os.path.basename(a)}")
+        with self._metrics.timer("stage_seconds", stage="merge"):
+            await self._merge(v, a, out)
+
+    async def _merge(self, v, a, out):
         def _ff(cmd):
             si = None
             if os.name == 'nt':
                 si = subprocess.STARTUPINFO()
                 si.dwFlags |= subprocess.STARTF_USESHOWWINDOW
             return subprocess.run(cmd, capture_output=True, text=True, startupinfo=si)
-        r = await asyncio.get_running_loop().run_in_executor(None, _ff,
+        r = await asyncio.get_running_loop().run_in_executor(self._cpu_pool, _ff,
             [self.ffmpeg_exe, "-i", v, "-i", a, "-c:v", "copy", "-c:a", "copy", "-y", out])
         if r.returncode != 0:
             self._dbg("合并", f"copy失败, 重试AAC: {r.stderr[:200]}")
-            r = await asyncio.get_running_loop().run_in_executor(None, _ff,
+            r = await asyncio.get_running_loop().run_in_executor(self._cpu_pool, _ff,
                 [self.ffmpeg_exe, "-i", v, "-i", a, "-c:v", "copy", "-c:a", "aac", "-y", out])
             if r.returncode != 0:
                 raise Exception(f"合并失败: {r.stderr[:200]}")
         self._dbg("合并", f"✅ {os.path.basename(out)}")
 
+    # ======= 超限转码 =======
+    async def _fit_to_budget(self, job, src, duration, budget_mb, audio_only):
+        """按 时长×预算 反推码率重新编码; 码率太低时同时降分辨率。
+        在 ffmpeg 线程池里以 nice 低优先级运行, 可被 job.cancel 中止; 失败返回 None"""
+        if not duration:
+            job.emit("⚠️ 时长未知, 无法计算转码码率, 跳过转码"); return None
+        total_kbps = budget_mb * 1024 * 1024 * 8 * 0.95 / duration / 1000  # 5% 留给封装
+        a_kbps = min(128, max(32, int(total_kbps * 0.15)))
+        v_kbps = int(total_kbps - a_kbps)
+        if not audio_only and v_kbps < 150:
+            job.emit(f"❌ 时长 {int(duration)}s 压到 {budget_mb}MB 只剩 {v_kbps}kbps, 画面不可用, 跳过转码")
+            return None
+        base, _ = os.path.splitext(src)
+        out = f"{base}_fit.m4a" if audio_only else f"{base}_fit.mp4"
+        cmd = [self.ffmpeg_exe, "-hide_banner", "-nostats", "-progress", "pipe:1", "-y", "-i", src]
+        if audio_only:
+            a_kbps = max(32, int(total_kbps))
+            cmd += ["-vn", "-c:a", "aac", "-b:a", f"{a_kbps}k"]
+            desc = f"音频 {a_kbps}kbps"
+        else:
+            h = 1080 if v_kbps >= 2500 else 720 if v_kbps >= 1200 else 480 if v_kbps >= 600 else 360
+            cmd += ["-vf", f"scale=-2:'min({h},ih)'", "-c:v", "libx264", "-preset", self.transcode_preset,
+                    "-b:v", f"{v_kbps}k", "-maxrate", f"{v_kbps}k", "-bufsize", f"{v_kbps * 2}k",
+                    "-c:a", "aac", "-b:a", f"{a_kbps}k", "-movflags", "+faststart"]
+            desc = f"≤{h}p 视频 {v_kbps}kbps + 音频 {a_kbps}kbps"
+        cmd.append(out)
+        if self.transcode_nice and os.name != 'nt' and shutil.which("nice"):
+            cmd = ["nice", "-n", str(self.transcode_nice)] + cmd
+        job.emit(f"🗜️ 超出 {budget_mb}MB, 转码压缩中 ({desc}, preset={self.transcode_preset})...")
+        self._dbg("转码", " ".join(cmd))
+
+        loop = asyncio.get_running_loop()
+        def _run():
+            si = None
+            if os.name == 'nt':
+                si = subprocess.STARTUPINFO()
+                si.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+            p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                 text=True, startupinfo=si)
+            # stderr 不读会把管道塞满卡死 ffmpeg
+            err = []
+            threading.Thread(target=lambda: err.extend(p.stderr), daemon=True).start()
+            last = time.monotonic()
+            for line in p.stdout:
+                if job.cancel.is_set():
+                    p.kill(); break
+                if line.startswith("out_time_us=") and time.monotonic() - last > 10:
+                    try: pct = int(line.split("=")[1]) / 1e6 / duration * 100
+                    except ValueError: continue
+                    last = time.monotonic()
+                    loop.call_soon_threadsafe(job.emit, f"🗜️ 转码 {min(pct, 99):.0f}%")
+            p.wait()
+            return p.returncode, "".join(err[-5:])
+        t0 = time.monotonic()
+        with self._metrics.timer("stage_seconds", stage="transcode"):
+            rc, err = await loop.run_in_executor(self._transcode_pool, _run)
+        if job.cancel.is_set():
+            if os.path.exists(out): os.remove(out)
+            raise _Cancelled()
+        if rc != 0 or not os.path.exists(out):
+            self._dbg("转码", f"❌ rc={rc} {err[-300:]}")
+            job.emit("⚠️ 转码失败, 按原文件处理")
+            if os.path.exists(out): os.remove(out)
+            return None
+        mb = os.path.getsize(out) / 1024**2
+        self._dbg("转码", f"✅ {mb:.1f}MB 用时 {time.monotonic() - t0:.1f}s")
+        job.emit(f"✅ 转码完成: {mb:.1f}MB")
+        return out
+
+    # ======= 边下边播 =======
+    def _progressive_ok(self, plan, raw):
+        """只有直连 http/hls 流、无需 cookie、预算内、直链未过期时才走 ffmpeg 直接拉流"""
+        if not (self.progressive and plan and plan['fits'] and plan['video']) or self._info_expired(raw):
+            return False
+        for f in (plan['video'], plan['audio']):
+            if f and (not f.get('url') or f.get('cookies')
+                      or f.get('protocol') not in ('http', 'https', 'm3u8', 'm3u8_native')):
+                self._dbg("边下边播", f"{f.get('format_id')} protocol={f.get('protocol')} 不支持, 走普通下载")
+                return False
+        return True
+
+    async def _start_progressive(self, job, plan, out):
+        """ffmpeg 直接从源直链 copy 封装成 fragmented MP4, 文件一有数据就挂到 HTTP 上边写边发;
+        源流起不来时返回 None, 由调用方退回普通下载"""
+        fmts = [f for f in (plan['video'], plan['audio']) if f]
+        cmd = [self.ffmpeg_exe, "-hide_banner", "-loglevel", "error", "-y"]
+        for f in fmts:
+            hdrs = "".join(f"{k}: {v}\r\n" for k, v in (f.get('http_headers') or {}).items())
+            if hdrs: cmd += ["-headers", hdrs]
+            if self.proxy_enabled and self.proxy_url: cmd += ["-http_proxy", self.proxy_url]
+            cmd += ["-i", f['url']]
+        cmd += ["-map", "0:v:0", "-map", f"{len(fmts) - 1}:a:0", "-c", "copy", "-f", "mp4",
+                "-movflags", "frag_keyframe+empty_moov+default_base_moof", out]
+        self._dbg("边下边播", " ".join(c if len(c) < 80 else c[:77] + "..." for c in cmd))
+
+        await self._acquire(job, 0)
+        p = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        # stderr 不读, 源站一直报错时会把管道塞满卡死 ffmpeg, 槽位永远不释放
+        err = []
+        reader = threading.Thread(target=lambda: err.extend(p.stderr), daemon=True)
+        reader.start()
+
+        def tail():  # 进程已退出, 管道关闭后读线程很快结束
+            reader.join(2)
+            return b"".join(err[-5:]).decode(errors="replace")[-300:]
+
+        deadline = time.monotonic() + 20
+        while p.poll() is None and time.monotonic() < deadline and not job.cancel.is_set():
+            if os.path.exists(out) and os.path.getsize(out) >= 64 * 1024: break
+            await asyncio.sleep(0.2)
+        size = os.path.getsize(out) if os.path.exists(out) else 0
+        # 源很快时 ffmpeg 可能在首次检查前就已写完
+        ready = size >= 64 * 1024 if p.poll() is None else p.returncode == 0 and size > 0
+        if job.cancel.is_set() or not ready:
+            if p.poll() is None: p.kill()
+            self._dbg("边下边播", f"❌ 未能起流 rc={p.returncode} {tail() if p.wait() else ''}")
+            self._sched.release(job.chat)
+            if os.path.exists(out): os.remove(out)
+            if job.cancel.is_set(): raise _Cancelled()
+            return None
+
+        route = "/" + os.path.basename(out)
+        g = _GrowingFile(out, job.t0, self.logger)
+        self._routes[route] = g.serve
+        ready = time.monotonic() - job.t0
+        self.logger.info(f"边下边播就绪: {os.path.basename(out)} 用时 {ready:.1f}s")
+        job.emit(f"⚡ 边下边播: {ready:.1f}s 后即可播放, 后台继续下载")
+
+        async def _watch():
+            try:
+                while p.poll() is None:
+                    if job.cancel.is_set(): p.kill()
+                    await asyncio.sleep(1)
+                if p.returncode != 0:
+                    self.logger.warning(f"边下边播中断 rc={p.returncode}: {tail()}")
+            finally:
+                g.done.set()
+                self._routes.pop(route, None)  # 写完后交给静态文件服务 (支持 Range)
+                self._sched.release(job.chat)
+                self._dbg("边下边播", f"完成 总用时 {time.monotonic() - job.t0:.1f}s "
+                          f"TTFB={'%.1fs' % g.ttfb if g.ttfb is not None else '无请求'}")
+        asyncio.create_task(_watch())
+        return {'growing': g, 'route': route, 'size': plan['size'],
+                'url': f"http://{self.server_ip}:{self.server_port}{urllib.parse.quote(route)}"}
+
+    # ======= 解析结果复用 =======
+    def _info_expired(self, info, margin=60):
+        """签名直链是否已过期 (YouTube 等在 URL 里带 expire 时间戳)"""
+        now = time.time()
+        for f in (info.get('formats') or [info]):
+            m = re.search(r'[?&/]expire[=/](\d+)', f.get('url') or '')
+            if m and int(m.group(1)) < now + margin:
+                return True
+        return False
+
+    def _is_expired_error(self, err_msg):
+        e = err_msg.lower()
+        return "403" in err_msg or "410" in err_msg or "forbidden" in e or "expired" in e
+
     # ======= 解析视频信息 =======
-    async def _get_video_info_safe(self, url):
+    async def _get_video_info_safe(self, url, ctr=None):
         self._dbg("解析", f"URL: {url[:120]}")
+        if ctr is not None: ctr['extract'] += 1
         # 排查用：明确打印 cookie/proxy 状态
         self._dbg("解析", f"proxy={self.proxy_enabled} cookie={'✓ '+self.cookies_path if self.cookies_path else '✗ 未找到'}")
         opts = self._inject({
@@ -190,40 +575,227 @@ class YtDlpPlugin(Star):
             "extract_flat": "in_playlist",
             "extractor_args": {"youtube": {"player_client": ["android", "web"]}},
         })
+        def _task():
+            with self._ydl_pool.checkout(opts) as ydl:
+                return ydl.extract_info(url, download=False)
         try:
-            info = await asyncio.get_running_loop().run_in_executor(
-                None, lambda: yt_dlp.YoutubeDL(opts).extract_info(url, download=False))
+            with self._metrics.timer("stage_seconds", stage="parse"):
+                info = await asyncio.get_running_loop().run_in_executor(self._parse_pool, _task)
             if info.get('_type') == 'playlist':
                 c = info.get('playlist_count', len(info.get('entries', [])))
                 return {'success':True,'is_playlist':True,'title':info.get('title','?'),'count':c,'entries':info.get('entries',[])}
             sz = info.get('filesize') or info.get('filesize_approx')
             self._dbg("解析", f"✅ '{info.get('title','?')}' {self._format_size(sz)}")
-            return {'success':True,'is_playlist':False,'title':info.get('title',''),'filesize':sz}
+            return {'success':True,'is_playlist':False,'title':info.get('title',''),'filesize':sz,'raw':info,
+                    'extractor':info.get('extractor_key') or info.get('extractor',''),'id':info.get('id','')}
         except Exception as e:
             self.logger.error(f"解析异常: {type(e).__name__}: {e}")
             self._dbg("解析", f"❌ {type(e).__name__}: {str(e)[:500]}")
             return {'success':False,'error':str(e),'error_type':type(e).__name__}
 
+    # ======= 格式规划 =======
+    def _fmt_size(self, f, duration):
+        sz = f.get('filesize') or f.get('filesize_approx')
+        if not sz and f.get('tbr') and duration:
+            sz = f['tbr'] * 1000 / 8 * duration
+        return int(sz) if sz else None
+
+    def _plan_formats(self, info, ctype, budget_mb, force=False):
+        """下载前按 formats 的体积估算, 挑 画质最好且装得进预算 的 视频+音频 组合;
+        都装不下时返回最小的组合 (fits=False), force 则不管预算取画质最好的;
+        没有可用体积信息时返回 None (退回原来的格式字符串)"""
+        fmts, dur = info.get('formats') or [], info.get('duration')
+        budget = budget_mb * 1024 * 1024 * 0.97  # 给封装开销留余量
+        limit = None if self.max_quality == "最高画质" else int(self.max_quality.replace('p', ''))
+        h264 = lambda f: (f.get('vcodec') or '').startswith(('avc1', 'h264'))
+        vids, auds, muxed = [], [], []
+        for f in fmts:
+            vc, ac = f.get('vcodec') or 'none', f.get('acodec') or 'none'
+            sz = self._fmt_size(f, dur)
+            if not sz or not f.get('format_id') or f.get('protocol') == 'mhtml': continue
+            if vc != 'none' and limit and (f.get('height') or 0) > limit: continue
+            if vc != 'none' and ac == 'none': vids.append((f, sz))
+            elif vc == 'none' and ac != 'none': auds.append((f, sz))
+            elif vc != 'none': muxed.append((f, sz))
+        if ctype == "audio_only":
+            cands = [((a,), sz) for a, sz in auds]
+            rank = lambda c: (c[0][0].get('abr') or c[0][0].get('tbr') or 0, c[1])
+        else:
+            cands = [((v, a), vs + as_) for v, vs in vids for a, as_ in auds] + [((m,), sz) for m, sz in muxed]
+            # 优先 H.264 时编码比分辨率更重要 (与原格式字符串里强制 avc1 一致)
+            rank = lambda c: (h264(c[0][0]) if self.prefer_h264 else True,
+                              c[0][0].get('height') or 0,
+                              c[0][0].get('ext') == 'mp4' and c[0][-1].get('ext') in ('mp4', 'm4a'),
+                              c[1])
+        if not cands: return None
+        fit = [c for c in cands if c[1] <= budget]
+        if fit: parts, size = max(fit, key=rank)
+        elif force: parts, size = max(cands, key=rank)
+        else: parts, size = min(cands, key=lambda c: c[1])
+        desc = " + ".join(
+            f"{f['format_id']}({f.get('height') or '?'}p {(f.get('vcodec') or '?').split('.')[0]})"
+            if (f.get('vcodec') or 'none') != 'none' else f"{f['format_id']}({f.get('ext', '?')})"
+            for f in parts)
+        return {'video': None if ctype == "audio_only" else parts[0],
+                'audio': parts[-1] if ctype == "audio_only" or len(parts) == 2 else None,
+                'size': size, 'fits': bool(fit), 'desc': desc}
+
     # ======= 下载流 =======
-    async def _download_stream(self, url, fmt, tmpl):
-        self._dbg("下载", f"fmt={fmt}")
+    async def _download_stream(self, url, fmt, tmpl, info=None, ctr=None, cancel=None, stage="video", site=None,
+                               progress=None):
+        """info 为已解析的结果时直接复用, 只有直链过期才重新 extract;
+        cancel (threading.Event) 被置位时在下一次进度回调中中止下载; stage 用于指标分类;
+        site 为调优用的站点名, 默认取 info 的 extractor, 没有时用域名;
+        progress 为额外的进度回调 (聊天进度 / 超预算中止, 见 _Progress)"""
+        reuse = bool(info) and not self._info_expired(info)
+        self._dbg("下载", f"fmt={fmt} 复用解析={'✓' if reuse else '✗'}")
         opts = self._inject({
-            "outtmpl": tmpl, "format": fmt, "noplaylist": True,
-            "quiet": True, "ffmpeg_location": None,
+            "noplaylist": True, "quiet": True, "ffmpeg_location": None,
             "extractor_args": {"youtube": {"player_client": ["android", "web"]}},
         })
+        hooks = []
+        if cancel is not None:
+            def _hook(d):
+                if cancel.is_set():
+                    raise yt_dlp.utils.DownloadCancelled("下载已取消")
+            hooks.append(_hook)
+        if progress: hooks.append(progress)
+        site = site or (info or {}).get('extractor_key') or (urllib.parse.urlsplit(url).hostname or "?").removeprefix("www.")
+        arm, tune = self._tuner.pick(site) if self.adaptive_tuning else (None, {})
+        got = {'bytes': 0, 'secs': 0.0}
+        if arm:
+            def _measure(d):
+                # 每个实际下载的文件结束时一次; 已存在而跳过的文件没有 elapsed
+                if d.get('status') == 'finished' and d.get('elapsed'):
+                    got['bytes'] += d.get('total_bytes') or d.get('downloaded_bytes') or 0
+                    got['secs'] += d['elapsed']
+            hooks.append(_measure)
         def _task():
-            with yt_dlp.YoutubeDL(opts) as ydl:
-                info = ydl.extract_info(url, download=True)
-                fn = ydl.prepare_filename(info)
-                self._dbg("下载", f"✅ {os.path.basename(fn)}")
-                return fn, info
-        return await asyncio.get_running_loop().run_in_executor(None, _task)
+            if cancel is not None and cancel.is_set():
+                raise yt_dlp.utils.DownloadCancelled("下载已取消")
+            t0 = time.monotonic()
+            try:
+                with self._ydl_pool.checkout(opts, format=fmt, outtmpl=tmpl, progress_hooks=hooks, **tune) as ydl:
+                    res = None
+                    if reuse:
+                        try:
+                            res = ydl.process_ie_result(
+                                yt_dlp.YoutubeDL.sanitize_info(info, True), download=True)
+                            if ctr is not None: ctr['reuse'] += 1
+                        except yt_dlp.utils.DownloadError as e:
+                            if not self._is_expired_error(str(e)): raise
+                            self._dbg("下载", f"直链失效, 重新解析: {str(e)[:120]}")
+                    if res is None:
+                        if ctr is not None: ctr['extract'] += 1
+                        res = ydl.extract_info(url, download=True)
+                    fn = ydl.prepare_filename(res)
+            except yt_dlp.utils.DownloadCancelled:
+                raise
+            except Exception:
+                if arm: self._tuner.record(site, arm, False)
+                raise
+            if arm:
+                self._tuner.record(site, arm, True, got['bytes'], got['secs'])
+                self._dbg("调优", self._tuner.describe(site, arm))
+            cost = time.monotonic() - t0
+            size = os.path.getsize(fn) if os.path.exists(fn) else (res.get('filesize') or 0)
+            self._metrics.record_download(
+                f"{stage}_download", res.get('extractor_key') or urllib.parse.urlsplit(url).hostname or "?", size, cost)
+            self._dbg("下载", f"✅ {os.path.basename(fn)} {self._format_size(size)} {cost:.1f}s")
+            return fn, res
+        return await asyncio.get_running_loop().run_in_executor(self._net_pool, _task)
+
+    async def _download_pair(self, url, fv, fa, v_tmpl, a_tmpl, info=None, ctr=None, progress=None):
+        """音视频流并发下载; 任一路失败即取消另一路, 并清理两路的残留文件"""
+        cancel = threading.Event()
+        cost = {}
+        async def _one(key, fmt, tmpl):
+            t = time.monotonic()
+            r = await self._download_stream(url, fmt, tmpl, info, ctr, cancel,
+                                            stage="video" if key == "v" else "audio",
+                                            progress=progress.hook(key) if progress else None)
+            cost[key] = time.monotonic() - t
+            return r
+        t0 = time.monotonic()
+        tasks = [asyncio.ensure_future(_one("v", fv, v_tmpl)),
+                 asyncio.ensure_future(_one("a", fa, a_tmpl))]
+        try:
+            (vp, vi), (ap, ai) = await asyncio.gather(*tasks)
+        except BaseException:
+            cancel.set()
+            # 等线程真正退出后再删文件, 否则 .part 会被重新写出来
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self._remove_partials(v_tmpl); self._remove_partials(a_tmpl)
+            raise
+        wall = time.monotonic() - t0
+        saved = cost["v"] + cost["a"] - wall
+        self._dbg("下载", f"并发: 视频 {cost['v']:.1f}s 音频 {cost['a']:.1f}s 实际 {wall:.1f}s 节省 {saved:.1f}s")
+        return vp, vi, ap, ai, saved
+
+    # ======= 播放列表 =======
+    async def _ensure_pyzipper(self, job):
+        try: import pyzipper
+        except ImportError:
+            job.emit("⚙️ 安装 pyzipper...")
+            def _pip():
+                cmd = [sys.executable, "-m", "pip", "install", "pyzipper"]
+                r = subprocess.run(cmd, capture_output=True, text=True)
+                if r.returncode != 0 and "externally-managed" in (r.stderr or ""):
+                    cmd.append("--break-system-packages")
+                    subprocess.run(cmd, capture_output=True)
+            await asyncio.get_running_loop().run_in_executor(self._pack_pool, _pip)
+
+    async def _download_playlist(self, job, entries, pf, on_file):
+        """条目有界并发下载, 每完成一个立即交给 on_file (打包线程队列 / 流式压缩包),
+        下载和打包重叠进行; 返回 [(序号, 标题, 错误)]"""
+        fmt = "bestvideo[height<=1080][ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best"
+        n = len(entries)
+        sem = asyncio.Semaphore(self.playlist_parallel)
+        failed, done = [], 0
+
+        async def _one(i, e):
+            nonlocal done
+            eurl = e.get('url') or e.get('webpage_url')
+            et = e.get('title') or e.get('id') or str(eurl)
+            if not eurl:
+                failed.append((i, et, "无链接")); self._count_error("无链接"); return
+            prefix = os.path.join(pf, f"{i:02d}_")
+            async with sem:
+                if job.cancel.is_set(): return
+                try:
+                    fn, _ = await self._download_stream(eurl, fmt, prefix + "%(title)s.%(ext)s", cancel=job.cancel,
+                                                        stage="playlist_entry", site=e.get('ie_key'))
+                except Exception as ex:
+                    if job.cancel.is_set(): return
+                    self._dbg("播放列表", f"#{i} 失败: {ex}")
+                    failed.append((i, et, str(ex)))
+                    self._count_error(str(ex))
+                    job.emit(f"❌ [{i}/{n}] {et[:30]}")
+                    return
+            # 合并后的扩展名可能和 prepare_filename 不一致, 以实际文件为准
+            for f in ([fn] if os.path.exists(fn) else glob.glob(glob.escape(prefix) + "*")):
+                on_file(f)
+            done += 1
+            job.emit(f"✅ [{done}/{n}] {et[:30]}")
+
+        await asyncio.gather(*(_one(i, e) for i, e in enumerate(entries, 1)))
+        return sorted(failed)
 
     # ======= 错误分析 =======
-    def _analyze_error(self, err_msg):
+    def _error_category(self, err_msg):
         e = err_msg.lower()
-        if "sign in to confirm" in e or "not a bot" in e:
+        if "sign in to confirm" in e or "not a bot" in e: return "bot_check"
+        if "412" in err_msg or "precondition" in e: return "http_412"
+        if "403" in err_msg or "forbidden" in e: return "http_403"
+        if "externally-managed" in e: return "pep668"
+        return "other"
+
+    def _count_error(self, err_msg):
+        self._metrics.inc("errors_total", category=self._error_category(err_msg))
+
+    def _analyze_error(self, err_msg):
+        cat = self._error_category(err_msg)
+        if cat == "bot_check":
             cookie_stat = "✅ 已配置" if self.cookies_path else "❌ 未配置"
             return (
                 "\n   ⚠️ YouTube 反爬：VPS IP 被标记\n"
@@ -232,109 +804,186 @@ class YtDlpPlugin(Star):
                 "   👉 已配置但无效: 检查 cookies.txt 是否过期/格式不对\n"
                 "   📖 获取 cookie: Chrome扩展 'Get cookies.txt LOCALLY'"
             )
-        if "412" in err_msg or "precondition" in e:
+        if cat == "http_412":
             return (
                 "\n   ⚠️ B站 412：yt-dlp 版本过旧\n"
                 "   👉 sudo python3 -m pip install -U --pre --break-system-packages \"yt-dlp[default]\""
             )
-        if "403" in err_msg or "forbidden" in e:
+        if cat == "http_403":
             return "\n   ⚠️ HTTP 403：可能需要开代理或 cookie"
-        if "externally-managed" in e:
+        if cat == "pep668":
             return "\n   ⚠️ Debian PEP 668：pip 被限制，加 --break-system-packages"
         return ""
 
+    # ======= 调度 =======
+    def _user_key(self, event):
+        """会话 + 发送者; /cancel 只能取消自己发起或加入的任务"""
+        get_sender = getattr(event, 'get_sender_id', None)
+        uid = get_sender() if callable(get_sender) else getattr(getattr(event, 'message_obj', None), 'user_id', None)
+        return f"{self._chat_key(event)}:{uid}"
+
+    def _chat_key(self, event):
+        m = getattr(event, 'message_obj', None)
+        if getattr(m, 'group_id', None): return f"g{m.group_id}"
+        if getattr(m, 'user_id', None): return f"u{m.user_id}"
+        return f"s{event.session_id}"
+
+    async def _acquire(self, job, prio):
+        """占用一个下载名额; prio 越小越先 (单视频 0, 播放列表 1)"""
+        def _queued(pos):
+            job.queued = True
+            job.emit(f"🕒 排队中: 第 {pos} 位 (运行中 {self._sched.running}/{self._sched.max_jobs})")
+        try: waited = await self._sched.acquire(job.chat, prio, _queued)
+        finally: job.queued = False
+        if job.cancel.is_set():
+            self._sched.release(job.chat)
+            raise _Cancelled()
+        if waited: job.emit("▶️ 轮到你了, 开始处理")
+
+    @contextlib.asynccontextmanager
+    async def _slot(self, job, prio):
+        await self._acquire(job, prio)
+        try: yield
+        finally: self._sched.release(job.chat)
+
+    async def terminate(self):
+        if self._janitor_task: self._janitor_task.cancel()
+        await asyncio.get_running_loop().run_in_executor(None, self._ready.wait, 10)
+        if self._httpd:
+            await asyncio.get_running_loop().run_in_executor(None, self._httpd.shutdown)
+            self._httpd.server_close()
+        for pool in (self._net_pool, self._parse_pool, self._cpu_pool, self._pack_pool, self._key_pool,
+                     self._transcode_pool):
+            pool.shutdown(wait=False, cancel_futures=True)
+
     # ======= 主下载流程 =======
-    async def _core_download_handler(self, event: AstrMessageEvent, url: str, method: str, ctype: str):
-        if not url: return
-        self._dbg("核心", f"url={url[:120]} method={method}")
+    async def _run_job(self, job, url, ctype, confirmed):
+        """实际执行 解析→下载→合并, 成品写入 job.result; 进度消息广播给所有等待者"""
+        try:
+            job.result = await self._produce(job, url, ctype, confirmed)
+        except (_Cancelled, asyncio.CancelledError):  # 后者: 排队时被 /cancel
+            self._metrics.inc("aborted_total", reason="cancel")
+            job.emit("🛑 任务已取消, 残留文件已清理")
+        except _QueueFull:
+            job.emit(f"⚠️ 当前排队任务已满({self._sched.max_queue}), 请稍后再试")
+        except Exception as e:
+            self.logger.error(f"任务异常: {type(e).__name__}: {e}")
+            job.emit(f"❌ 处理失败: {e}")
+        finally:
+            self._inflight.pop(job.key, None)
+            job.finish()
 
-        confirmed = False
-        if "--y" in url:
-            url = url.replace("--y", "").replace("  ", " ").strip()
-            confirmed = True
+    async def _produce(self, job, url, ctype, confirmed):
+        # 成品缓存按归一化 URL + 画质设置寻址, 命中时连解析都省掉 (解析失败、被风控时也能发)
+        ckey = self._cache_key(job.key[0], ctype) if self.cache_enabled else None
+        hit = ckey and self._cache.get(ckey)
+        if hit:
+            self.logger.info(f"缓存命中: {job.key[0]} ({ctype})")
+            job.emit("♻️ 命中缓存, 直接发送")
+            return {'path': hit[0], 'title': hit[1], 'password': None,
+                    'is_playlist': False, 'cached': True, 'temp_files': []}
+        if ckey: self.logger.info(f"缓存未命中: {job.key[0]} ({ctype})")
 
-        d = self._dbg_chat(event, "📡 步骤1: 解析资源信息...")
-        if d: yield d
+        self._dbg_emit(job, "📡 步骤1: 解析资源信息...")
 
-        yield event.plain_result("⏳ 正在解析资源信息...")
-        info = await self._get_video_info_safe(url)
+        job.emit("⏳ 正在解析资源信息...")
+        ctr = {'extract': 0, 'reuse': 0}
+        info = await self._get_video_info_safe(url, ctr)
 
         if not info.get('success'):
             err_msg = info.get('error', '?')
-            yield event.plain_result(f"❌ 解析失败\n📌 {info.get('error_type','?')}: {err_msg[:300]}")
-            yield event.plain_result("🔄 尝试自动更新 yt-dlp 后重试...")
+            job.emit(f"❌ 解析失败\n📌 {info.get('error_type','?')}: {err_msg[:300]}")
+            job.emit("🔄 尝试自动更新 yt-dlp 后重试...")
             updated, log = await self._try_update_ytdlp()
-            yield event.plain_result(f"{'✅ 已更新' if updated else '⚠️ 更新未成功'}, 重试中...")
-            info = await self._get_video_info_safe(url)
+            job.emit(f"{'✅ 已更新并热加载' if updated else '⚠️ 未能更新到新版本'}, 重试中...")
+            info = await self._get_video_info_safe(url, ctr)
 
         if not info.get('success'):
             err_msg = info.get('error', '?')
             hint = self._analyze_error(err_msg)
-            yield event.plain_result(
+            self._count_error(err_msg)
+            job.emit(
                 f"❌ 重试后仍然失败\n📌 {err_msg[:300]}{hint}\n"
                 f"💡 通用: 1)网站反爬更新 2)网络/代理 3)链接失效")
-            return
+            return None
 
-        d = self._dbg_chat(event, "✅ 解析成功")
-        if d: yield d
+        self._dbg_emit(job, "✅ 解析成功")
+        if job.cancel.is_set(): raise _Cancelled()
 
-        ts = int(time.time())
+        ts = time.time_ns() // 1000  # 微秒: 同一秒开始的并发任务不能共用 final_/pl_ 文件名
         final_password = None
+        cached = False
+        temp_files = []
+        stream = {}
 
         # ---- 播放列表 ----
         if info.get('is_playlist'):
             count, title = info['count'], info['title']
             if not confirmed:
-                yield event.plain_result(
+                job.emit(
                     f"📂 【{title}】\n🔢 {count}个\n⚠️ 确认？回复: /download {url} --y")
-                return
+                return None
             if count > 30:
-                yield event.plain_result(f"❌ {count} 超过限制(30)")
-                return
-
-            yield event.plain_result(f"📦 下载播放列表({count}个)...")
-            pf = os.path.join(self.temp_dir, f"pl_{ts}")
-            os.makedirs(pf, exist_ok=True)
-
-            opts = self._inject({
-                "outtmpl": f"{pf}/%(playlist_index)s_%(title)s.%(ext)s",
-                "format": "bestvideo[height<=1080][ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best",
-                "quiet": True, "ignoreerrors": True, "noplaylist": False,
-                "extractor_args": {"youtube": {"player_client": ["android", "web"]}},
-            })
-            try:
-                await asyncio.get_running_loop().run_in_executor(
-                    None, lambda: yt_dlp.YoutubeDL(opts).download([url]))
-            except Exception as e:
-                yield event.plain_result(f"⚠️ 部分出错: {e}")
-
-            files = glob.glob(os.path.join(pf, "*"))
-            if not files:
-                yield event.plain_result("❌ 无文件"); shutil.rmtree(pf); return
-
-            yield event.plain_result(f"🔐 加密打包 {len(files)} 个文件 (密码:123456)...")
-            try: import pyzipper
-            except ImportError:
-                yield event.plain_result("⚙️ 安装 pyzipper...")
-                def _pip():
-                    cmd = [sys.executable, "-m", "pip", "install", "pyzipper"]
-                    r = subprocess.run(cmd, capture_output=True, text=True)
-                    if r.returncode != 0 and "externally-managed" in (r.stderr or ""):
-                        cmd.append("--break-system-packages")
-                        subprocess.run(cmd, capture_output=True)
-                await asyncio.get_running_loop().run_in_executor(None, _pip)
-                import pyzipper
-
-            zip_name = f"Playlist_{self._sanitize_filename(title)}_Pwd123456.zip"
-            zip_path = os.path.join(self.temp_dir, zip_name)
-            await asyncio.get_running_loop().run_in_executor(None, lambda: _mzip(zip_path, files))
-            shutil.rmtree(pf)
-            final_path, video_title_real = zip_path, f"Playlist_{title}"
-            method, final_password = "file", "123456"
+                job.emit(f"❌ {count} 超过限制(30)")
+                return None
+
+            async with self._slot(job, 1):
+                entries = [e for e in (info.get('entries') or []) if e]
+                job.emit(f"📦 下载播放列表({len(entries)}个, 并发{self.playlist_parallel})...")
+                pf = os.path.join(self.temp_dir, f"pl_{ts}")
+                os.makedirs(pf, exist_ok=True)
+                await self._ensure_pyzipper(job)
+
+                zip_name = f"Playlist_{self._sanitize_filename(title)}_Pwd123456.zip"
+                if self.stream_archive:
+                    # 不落盘: 压缩包在 HTTP 请求时现场生成, 还没下完的条目会边等边发
+                    arc = _StreamArchive(b"123456")
+                    route = f"/pl_{ts}/{zip_name}"
+                    self._routes[route] = self._metrics.timed("zip", arc.serve)
+                    try:
+                        failed = await self._download_playlist(job, entries, pf, arc.add)
+                    finally:
+                        arc.close()
+                    packed = len(arc.files)
+                    if not packed: self._routes.pop(route, None)
+                    zip_path = pf
+                else:
+                    zip_path = os.path.join(self.temp_dir, zip_name)
+                    q = queue.Queue()
+                    zip_fut = asyncio.get_running_loop().run_in_executor(
+                        self._pack_pool, self._metrics.timed("zip", _mzip), zip_path, iter(q.get, None))
+                    try:
+                        failed = await self._download_playlist(job, entries, pf, q.put)
+                    finally:
+                        q.put(None)
+                    packed = await zip_fut
+                    shutil.rmtree(pf, ignore_errors=True)
+
+                if job.cancel.is_set():
+                    if self.stream_archive: self._routes.pop(route, None)
+                    shutil.rmtree(pf, ignore_errors=True)
+                    if os.path.exists(zip_path) and not os.path.isdir(zip_path): os.remove(zip_path)
+                    raise _Cancelled()
+                if self.adaptive_tuning and entries and entries[0].get('ie_key'):
+                    self._dbg_emit(job, f"📶 {self._tuner.describe(entries[0]['ie_key'])}")
+                if failed:
+                    lines = [f"  {i}. {t[:30]} ({err[:60]})" for i, t, err in failed]
+                    job.emit(f"⚠️ {len(failed)} 个失败:\n" + "\n".join(lines[:10])
+                             + ("\n  ..." if len(lines) > 10 else ""))
+                if not packed:
+                    job.emit("❌ 无文件")
+                    if os.path.isdir(zip_path): shutil.rmtree(zip_path, ignore_errors=True)
+                    elif os.path.exists(zip_path): os.remove(zip_path)
+                    return None
+                job.emit(f"🔐 已加密打包 {packed}/{len(entries)} 个文件 (密码:123456)")
+                final_path, video_title_real = zip_path, f"Playlist_{title}"
+                final_password = "123456"
+                if self.stream_archive:
+                    stream = {'archive': arc, 'route': route, 'name': zip_name,
+                              'url': f"http://{self.server_ip}:{self.server_port}{urllib.parse.quote(route)}"}
 
         # ---- 单视频 ----
         else:
-            yield event.plain_result(f"📹 {info['title'][:30]}...\n⏳ 开始下载...")
             v_tmpl = f"{self.temp_dir}/v_{ts}_%(id)s.%(ext)s"
             a_tmpl = f"{self.temp_dir}/a_{ts}_%(id)s.%(ext)s"
 
@@ -347,45 +996,173 @@ class YtDlpPlugin(Star):
             fa = "bestaudio[ext=m4a]/bestaudio"
             self._dbg("核心", f"画质={limit} v={fv} a={fa}")
 
-            try:
-                if ctype == "audio_only":
-                    final_path, ai = await self._download_stream(url, fa, a_tmpl)
-                    video_title_real = ai.get('title', 'audio'); temp_files = [final_path]
+            plan = None
+            if info.get('raw'):
+                plan = self._plan_formats(info['raw'], ctype, self.max_size_mb,
+                                          force=confirmed and not self.transcode_enabled)
+            muxed = False
+            if plan:
+                size_mb = plan['size'] / 1024**2
+                self._dbg("规划", f"{plan['desc']} ≈{size_mb:.1f}MB 预算={self.max_size_mb}MB fits={plan['fits']}")
+                if not plan['fits'] and self.transcode_enabled:
+                    job.emit(f"📐 没有能放进 {self.max_size_mb}MB 的格式, 下载最小的 ({plan['desc']} ≈{size_mb:.1f}MB) 后转码")
+                elif not plan['fits'] and not confirmed:
+                    job.emit(f"❌ 没有能放进 {self.max_size_mb}MB 的格式 (最小约 {size_mb:.1f}MB), 未开始下载\n"
+                             f"👉 仍要下载(超限发链接): /download {url} --y")
+                    return None
                 else:
-                    vp, vi = await self._download_stream(url, fv, v_tmpl)
-                    video_title_real = vi.get('title', 'video')
-                    ap, ai = await self._download_stream(url, fa, a_tmpl)
-                    yield event.plain_result("⚙️ 合并中...")
-                    out_path = os.path.join(self.temp_dir, f"final_{ts}.mp4")
-                    await self._manual_merge(vp, ap, out_path)
-                    final_path, temp_files = out_path, [vp, ap]
-            except Exception as e:
-                yield event.plain_result(f"❌ 下载错误: {e}")
-                updated, _ = await self._try_update_ytdlp()
-                if updated: yield event.plain_result("✅ yt-dlp 已更新, 请重试")
-                return
-
-        # ---- 上传 ----
+                    job.emit(f"📐 格式: {plan['desc']} ≈{size_mb:.1f}MB (上限 {self.max_size_mb}MB)")
+                if plan['video']: fv = plan['video']['format_id']
+                if plan['audio']: fa = plan['audio']['format_id']
+                # 只有音视频一体的格式 (Twitter/TikTok 常见), 不用再合并
+                muxed = ctype != "audio_only" and not plan['audio']
+
+            if not muxed and ctype != "audio_only" and self._progressive_ok(plan, info['raw']):
+                out_path = os.path.join(self.temp_dir, f"final_{ts}.mp4")
+                stream = await self._start_progressive(job, plan, out_path) or {}
+                if stream:
+                    final_path, video_title_real, ckey = out_path, info['title'], None
+
+            if not stream:
+                async with self._slot(job, 0):
+                    job.emit(f"📹 {info['title'][:30]}...\n⏳ 开始下载...")
+                    raw = info.get('raw')
+                    # 确认超限 (发链接) 或开了转码时不按预算中止
+                    limit = None if confirmed or self.transcode_enabled else self.max_size_mb * 1024**2
+                    planned = {k: self._fmt_size(plan[n], (raw or {}).get('duration')) or 0
+                               for k, n in (("v", "video"), ("a", "audio")) if plan and plan[n]}
+                    prog = _Progress(job, limit, planned, self.progress_interval)
+                    try:
+                        if ctype == "audio_only":
+                            final_path, ai = await self._download_stream(url, fa, a_tmpl, raw, ctr, stage="audio",
+                                                                         progress=prog.hook("a"))
+                            video_title_real = ai.get('title', 'audio')
+                        elif muxed:
+                            final_path, vi = await self._download_stream(url, fv, v_tmpl, raw, ctr,
+                                                                         progress=prog.hook("v"))
+                            video_title_real = vi.get('title', 'video')
+                        elif self.concurrent_streams:
+                            vp, vi, ap, ai, saved = await self._download_pair(url, fv, fa, v_tmpl, a_tmpl, raw, ctr,
+                                                                              progress=prog)
+                            video_title_real = vi.get('title', 'video')
+                            self._dbg_emit(job, f"⚡ 音视频并发下载, 节省 {saved:.1f}s")
+                            job.emit("⚙️ 合并中...")
+                            out_path = os.path.join(self.temp_dir, f"final_{ts}.mp4")
+                            await self._manual_merge(vp, ap, out_path)
+                            final_path, temp_files = out_path, [vp, ap]
+                        else:
+                            vp, vi = await self._download_stream(url, fv, v_tmpl, raw, ctr, progress=prog.hook("v"))
+                            video_title_real = vi.get('title', 'video')
+                            ap, ai = await self._download_stream(url, fa, a_tmpl, raw, ctr, stage="audio",
+                                                                 progress=prog.hook("a"))
+                            job.emit("⚙️ 合并中...")
+                            out_path = os.path.join(self.temp_dir, f"final_{ts}.mp4")
+                            await self._manual_merge(vp, ap, out_path)
+                            final_path, temp_files = out_path, [vp, ap]
+                        if job.cancel.is_set(): raise _Cancelled()
+                    except Exception as e:
+                        # 中间的音视频流和半成品没有交付, 不等清扫直接删
+                        self._remove_partials(v_tmpl); self._remove_partials(a_tmpl)
+                        self._remove_partials(os.path.join(self.temp_dir, f"final_{ts}.mp4"))
+                        if job.cancel.is_set(): raise _Cancelled()
+                        if prog.oversize:
+                            self._metrics.inc("aborted_total", reason="oversize")
+                            job.emit(f"{prog.oversize}\n🧹 已中止下载并清理\n"
+                                     f"👉 仍要下载(超限发链接): /download {url} --y")
+                            return None
+                        job.emit(f"❌ 下载错误: {e}")
+                        self._count_error(str(e))
+                        updated, _ = await self._try_update_ytdlp()
+                        if updated: job.emit("✅ yt-dlp 已更新, 请重试")
+                        return None
+                    self._dbg("核心", f"extract 次数={ctr['extract']} 复用={ctr['reuse']}")
+                    self._dbg_emit(job, f"📊 extract {ctr['extract']} 次, 复用解析 {ctr['reuse']} 次")
+                    if self.adaptive_tuning and info.get('extractor'):
+                        self._dbg_emit(job, f"📶 {self._tuner.describe(info['extractor'])}")
+                # 已经装得进预算 (copy 合并即可) 时不转码; 下载已结束, 先让出下载名额再转码
+                if self.transcode_enabled and os.path.getsize(final_path) > self.max_size_mb * 1024**2:
+                    try:
+                        fit = await self._fit_to_budget(job, final_path, (raw or {}).get('duration'),
+                                                        self.max_size_mb, ctype == "audio_only")
+                    except _Cancelled:
+                        self._janitor.track(temp_files + [final_path], 0)  # 下一轮清扫删掉
+                        raise
+                    if fit: temp_files, final_path = temp_files + [final_path], fit
+                # 超限发链接的 (--y) 或比整个缓存预算还大的不入缓存: 留给清扫按时删,
+                # 否则会把其它缓存全部挤掉, 自己还常驻超出预算
+                if ckey and os.path.getsize(final_path) <= min(self._cache.budget, self.max_size_mb * 1024**2):
+                    final_path = self._cache.put(ckey, final_path, video_title_real)
+                    cached = True
+
         if not final_path or not os.path.exists(final_path):
+            job.emit("❌ 文件生成失败"); return None
+        return {'path': final_path, 'title': video_title_real, 'password': final_password,
+                'is_playlist': bool(info.get('is_playlist')), 'cached': cached, 'temp_files': temp_files,
+                **stream}
+
+    async def _core_download_handler(self, event: AstrMessageEvent, url: str, method: str, ctype: str):
+        """请求入口: 相同资源的并发请求挂到同一个 _Job 上, 各自收进度、各自上传"""
+        if not url: return
+        self._dbg("核心", f"url={url[:120]} method={method}")
+        self._start_janitor()
+        await self._ensure_ready()
+
+        confirmed = False
+        if "--y" in url:
+            url = url.replace("--y", "").replace("  ", " ").strip()
+            confirmed = True
+
+        self._metrics.inc("requests_total", ctype=ctype)
+        canon = await asyncio.get_running_loop().run_in_executor(self._key_pool, self._canonical_key, url)
+        key = (canon, ctype, confirmed)
+        job = self._inflight.get(key)
+        joined = job is not None
+        if not joined:
+            job = _Job(key, self._chat_key(event))
+            self._inflight[key] = job
+            job.task = asyncio.create_task(self._run_job(job, url, ctype, confirmed))
+        # 先订阅再 yield: yield 期间任务可能已经结束, 晚订阅就收不到结束标记
+        job.users.add(self._user_key(event))
+        q = job.subscribe()
+
+        try:
+            if joined:
+                self._dbg("核心", f"合并到进行中的任务: {canon}")
+                self._metrics.inc("coalesced_total")
+                yield event.plain_result("🔗 相同资源正在处理中, 已加入等待, 完成后一起发送")
+            while (msg := await q.get()) is not None:
+                yield event.plain_result(msg)
+            res = job.result
+            if not res: return
+            async for r in self._deliver(event, res, method): yield r
+        finally:
+            if job.release() and job.result:
+                self._retire(job.result)
+
+    # ======= 上传 =======
+    async def _deliver(self, event, res, method):
+        final_path, video_title_real, final_password = res['path'], res['title'], res['password']
+        if res['is_playlist']: method = "file"
+        if not os.path.exists(final_path):
             yield event.plain_result("❌ 文件生成失败"); return
 
-        fsize_mb = os.path.getsize(final_path) / (1024 * 1024)
-        self._dbg("核心", f"文件={os.path.basename(final_path)} {fsize_mb:.1f}MB")
-        d = self._dbg_chat(event, f"📦 文件就绪: {fsize_mb:.1f}MB")
-        if d: yield d
+        arc = res.get('archive')
+        if res.get('growing'): fsize = res['size']  # 还在写, 用规划时的估算
+        elif arc: fsize = arc.size()
+        else: fsize = os.path.getsize(final_path)
+        fsize_mb = fsize / (1024 * 1024)
+        self._dbg("核心", f"文件={res.get('name') or os.path.basename(final_path)} {fsize_mb:.1f}MB")
+        if self.debug_mode: yield event.plain_result(f"🔍 📦 文件就绪: {fsize_mb:.1f}MB")
 
-        max_limit = 500 if info.get('is_playlist') else self.max_size_mb
+        max_limit = 500 if res['is_playlist'] else self.max_size_mb
         pwd_hint = f"\n🔐 **解压密码: {final_password}**" if final_password else ""
 
+        furl = res.get('url') or self._file_url(final_path)
         if fsize_mb > max_limit:
-            fn = os.path.basename(final_path)
-            furl = f"http://{self.server_ip}:{self.server_port}/{fn}"
             yield event.plain_result(f"⚠️ 文件过大({fsize_mb:.1f}MB)\n🔗 {furl}{pwd_hint}\n⏳ {self.delete_seconds}s 后清理")
         else:
-            fn = os.path.basename(final_path)
-            furl = f"http://{self.server_ip}:{self.server_port}/{fn}"
             safe = self._sanitize_filename(video_title_real)
-            ext = os.path.splitext(final_path)[1]
+            ext = os.path.splitext(res.get('name') or final_path)[1]
             dname = f"{safe}{ext}"
             if final_password and "Pwd" not in dname:
                 dname = f"Pwd{final_password}_{dname}"
@@ -405,22 +1182,37 @@ class YtDlpPlugin(Star):
                     act = "upload_group_file" if is_group else "upload_private_file"
                     key = "group_id" if is_group else "user_id"
                     try:
-                        await event.bot.call_action(act, **{key: int(tid), "file": furl, "name": dname})
+                        with self._metrics.timer("stage_seconds", stage="upload"):
+                            await event.bot.call_action(act, **{key: int(tid), "file": furl, "name": dname})
                     except Exception as ue:
+                        self._metrics.inc("errors_total", category="upload")
                         yield event.plain_result(f"❌ 上传失败: {ue}\n🔗 {furl}{pwd_hint}")
                 else:
                     yield event.plain_result(f"🔗 {furl}{pwd_hint}")
             else:
                 yield event.chain_result([Video(file=furl, url=furl)])
 
-        async def _clean():
-            w = 120 if info.get('is_playlist') else self.delete_seconds + 30
-            await asyncio.sleep(w)
-            if os.path.exists(final_path): os.remove(final_path)
-            if 'temp_files' in locals():
-                for f in temp_files:
-                    if os.path.exists(f): os.remove(f)
-        asyncio.create_task(_clean())
+    def _cache_key(self, canon, ctype):
+        """成品缓存键: 归一化资源 + 决定选哪个格式、是否转码的设置, 不用解析就能算出"""
+        fmt = f"{self.max_quality}|h264={self.prefer_h264}|{self.max_size_mb}MB"
+        if self.transcode_enabled: fmt += "|fit"
+        return _ResultCache.make_key(canon, fmt, ctype)
+
+    def _canonical_key(self, url):
+        """URL 归一化为 extractor:id (不发网络请求); 认不出时退回去掉追踪参数的 URL。
+        除追踪参数外的查询参数都保留 (B 站 ?p=2 选分P 等), 宁可少合并也不能把不同内容合成一个任务"""
+        p = urllib.parse.urlsplit(url.strip())
+        q = sorted((k, v) for k, v in urllib.parse.parse_qsl(p.query)
+                   if not k.startswith(("utm_", "spm", "share_")) and k not in ("si", "vd_source", "feature"))
+        for ie in yt_dlp.extractor.gen_extractor_classes():
+            if ie.ie_key() == "Generic" or not ie.suitable(url): continue
+            vid = ie.get_temp_id(url)
+            if not vid: break
+            # 本身就是 id 的参数 (YouTube ?v=) 不重复计入, watch?v= 和 youtu.be/ 仍归为同一个
+            q = [(k, v) for k, v in q if v != vid]
+            return f"{ie.ie_key()}:{vid}" + (f"?{urllib.parse.urlencode(q)}" if q else "")
+        return urllib.parse.urlunsplit(
+            (p.scheme.lower(), p.netloc.lower(), p.path.rstrip("/"), urllib.parse.urlencode(q), ""))
 
     # ======= 命令 =======
     @command("download")
@@ -439,12 +1231,30 @@ class YtDlpPlugin(Star):
         if "--y" not in ful and "--y" in raw: ful += " --y"
         async for r in self._core_download_handler(event, ful, "video", "merged"): yield r
 
+    @command("cancel")
+    async def cmd_cancel(self, event: AstrMessageEvent):
+        user = self._user_key(event)
+        jobs = [j for j in self._inflight.values() if user in j.users]
+        if not jobs: yield event.plain_result("ℹ️ 你没有进行中的任务"); return
+        done = shared = 0
+        for job in jobs:
+            # 合并进来的其他人还在等同一个任务, 不能替他们取消
+            if len(job.users) > 1:
+                shared += 1; continue
+            job.cancel.set()
+            if job.queued: job.task.cancel()
+            done += 1
+        msg = f"🛑 正在取消 {done} 个任务..." if done else ""
+        if shared: msg += f"\n⚠️ {shared} 个任务还有其他人在等待, 未取消"
+        yield event.plain_result(msg.strip())
+
     @command("直链")
     async def cmd_get_direct_url(self, event: AstrMessageEvent, url: str = ""):
         raw = event.message_str; ful = url
         for p in ["/直链 ", "直链 "]:
             if p in raw: ful = raw.split(p, 1)[1].strip()
         if not ful: yield event.plain_result("❌ 请提供视频链接"); return
+        await self._ensure_ready()
 
         yield event.plain_result("⏳ 解析直链...")
         opts = self._inject({
@@ -452,9 +1262,11 @@ class YtDlpPlugin(Star):
             "noplaylist": True, "skip_download": True,
             "extractor_args": {"youtube": {"player_client": ["android", "web"]}},
         })
+        def _task():
+            with self._ydl_pool.checkout(opts) as ydl:
+                return ydl.extract_info(ful, download=False)
         try:
-            info = await asyncio.get_running_loop().run_in_executor(
-                None, lambda: yt_dlp.YoutubeDL(opts).extract_info(ful, download=False))
+            info = await asyncio.get_running_loop().run_in_executor(self._parse_pool, _task)
         except Exception as e:
             yield event.plain_result(f"❌ 解析失败: {e}"); return
         if not info: yield event.plain_result("❌ 无法获取信息"); return
@@ -488,9 +1300,779 @@ class YtDlpPlugin(Star):
         yield event.plain_result("\n".join(lines))
 
 
-def _mzip(zip_path, files):
+# 已经压缩过的媒体格式, deflate 只浪费 CPU
+_STORE_EXT = {".mp4", ".m4a", ".webm", ".mkv", ".flv", ".mov", ".mp3", ".aac", ".opus", ".ogg",
+              ".jpg", ".jpeg", ".png", ".webp", ".zip"}
+
+
+def _mzip(dst, files, password=b"123456"):
+    """dst 为路径或不可 seek 的可写流 (此时写 data descriptor);
+    files 可以是边下载边产出的迭代器; 返回写入的文件数"""
     import pyzipper
-    with pyzipper.AESZipFile(zip_path, 'w', compression=pyzipper.ZIP_DEFLATED,
+    n = 0
+    with pyzipper.AESZipFile(dst, 'w', compression=pyzipper.ZIP_DEFLATED,
                              encryption=pyzipper.WZ_AES) as zf:
-        zf.setpassword(b"123456")
-        for f in files: zf.write(f, os.path.basename(f))
+        zf.setpassword(password)
+        for f in files:
+            store = os.path.splitext(f)[1].lower() in _STORE_EXT
+            zf.write(f, os.path.basename(f),
+                     compress_type=pyzipper.ZIP_STORED if store else pyzipper.ZIP_DEFLATED)
+            n += 1
+    return n
+
+
+class _StreamArchive:
+    """不落盘的加密 zip: 文件陆续 add 进来, 每个 HTTP 请求现场打包直接写进 socket,
+    还没 add 的条目边等边发; 内存占用只有拷贝缓冲区, 与列表大小无关"""
+    def __init__(self, password):
+        self.password = password
+        self.files = []
+        self.closed = False
+        self.active = 0  # 正在发送的请求数; 大于 0 时清理要等
+        self._cond = threading.Condition()
+
+    def add(self, path):
+        with self._cond:
+            self.files.append(path)
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def size(self):
+        """近似大小 (不含 zip 头), 用于上传限额判断"""
+        return sum(os.path.getsize(f) for f in self.files if os.path.exists(f))
+
+    def __iter__(self):
+        i = 0
+        while True:
+            with self._cond:
+                while i >= len(self.files) and not self.closed:
+                    self._cond.wait()
+                if i >= len(self.files): return
+                f = self.files[i]
+            i += 1
+            yield f
+
+    def serve(self, handler, head):
+        # 长度事先未知: 不发 Content-Length, 以关闭连接表示结束
+        handler.send_response(200)
+        handler.send_header("Content-Type", "application/zip")
+        handler.send_header("Connection", "close")
+        handler.end_headers()
+        if head: return
+        with self._cond: self.active += 1
+        try: _mzip(handler.wfile, iter(self), self.password)
+        finally:
+            with self._cond: self.active -= 1
+
+
+class _FileHandler(BaseHTTPRequestHandler):
+    """temp 目录文件服务: 多线程并发, 支持 Range/206 与 keep-alive, 正文走 sendfile 零拷贝"""
+    protocol_version = "HTTP/1.1"
+    timeout = 60  # keep-alive 空闲连接最多占一个线程这么久
+    root = None
+    routes = {}
+
+    def log_message(self, *a): pass
+
+    def do_GET(self): self._serve(head=False)
+    def do_HEAD(self): self._serve(head=True)
+
+    def _resolve(self):
+        rel = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path).lstrip("/")
+        root = os.path.realpath(self.root)
+        full = os.path.realpath(os.path.join(root, rel))
+        return full if full.startswith(root + os.sep) and os.path.isfile(full) else None
+
+    def _range(self, size):
+        """解析单段 Range; 返回 (start, end), 不可满足时返回 None, 无 Range 时返回整个文件"""
+        m = re.fullmatch(r"bytes=(\d*)-(\d*)", (self.headers.get("Range") or "").strip())
+        if not m or not (m.group(1) or m.group(2)):
+            return 0, size - 1
+        if m.group(1):
+            start = int(m.group(1))
+            end = min(int(m.group(2)), size - 1) if m.group(2) else size - 1
+        else:
+            start, end = max(0, size - int(m.group(2))), size - 1
+        return (start, end) if start <= end else None
+
+    def _serve(self, head):
+        route = self.routes.get(urllib.parse.unquote(urllib.parse.urlsplit(self.path).path))
+        if route:
+            try: route(self, head)
+            except (BrokenPipeError, ConnectionResetError): pass
+            except Exception:
+                # 动态内容没有 Content-Length, 正常关闭会被客户端当成下完了; 发到一半出错时用 RST 断开
+                self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+                self.connection.close()
+            self.close_connection = True
+            return
+        full = self._resolve()
+        if not full:
+            self.send_error(404); return
+        st = os.stat(full)
+        rng = self._range(st.st_size)
+        if rng is None:
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{st.st_size}")
+            self.send_header("Content-Length", "0")
+            self.end_headers(); return
+        start, end = rng
+        partial = bool(self.headers.get("Range")) and (start, end) != (0, st.st_size - 1)
+        self.send_response(206 if partial else 200)
+        self.send_header("Content-Type", mimetypes.guess_type(full)[0] or "application/octet-stream")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Last-Modified", formatdate(st.st_mtime, usegmt=True))
+        if partial:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{st.st_size}")
+        self.end_headers()
+        if head or st.st_size == 0: return
+        try:
+            with open(full, "rb") as f:
+                self.connection.sendfile(f, start, end - start + 1)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+
+class _GrowingFile:
+    """ffmpeg 还在写的文件: 读到末尾就等新数据, 写完再把剩下的发完;
+    长度未知所以不发 Content-Length, 以关闭连接结束"""
+    def __init__(self, path, t0, logger):
+        self.path = path
+        self.t0 = t0
+        self.logger = logger
+        self.ttfb = None
+        self.done = threading.Event()
+
+    def serve(self, handler, head):
+        handler.send_response(200)
+        handler.send_header("Content-Type", "video/mp4")
+        handler.send_header("Connection", "close")
+        handler.end_headers()
+        if head: return
+        finished = False
+        with open(self.path, "rb") as f:
+            while True:
+                chunk = f.read(256 * 1024)
+                if chunk:
+                    handler.wfile.write(chunk)
+                    if self.ttfb is None:
+                        self.ttfb = time.monotonic() - self.t0
+                        self.logger.info(f"边下边播首字节: {os.path.basename(self.path)} TTFB={self.ttfb:.1f}s")
+                    continue
+                if finished: break
+                # done 之后再读一轮, 防止漏掉最后写入的数据
+                finished = self.done.is_set()
+                if not finished: self.done.wait(0.2)
+
+
+class _Metrics:
+    """进程内指标 (各阶段耗时直方图 / 各站点吞吐 / 错误分类计数等), 由文件服务的 /metrics 以 Prometheus 文本格式导出"""
+    BUCKETS = (0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+    def __init__(self, prefix="ytdlp"):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._hist = {}      # (name, labels) -> [各桶计数, sum, count]
+        self._counters = {}  # (name, labels) -> value
+        self._gauges = {}    # (name, labels) -> value
+        self._gauge_fns = {}  # name -> fn()
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            h = self._hist.setdefault(key, [[0] * len(self.BUCKETS), 0.0, 0])
+            for i, b in enumerate(self.BUCKETS):
+                if value <= b: h[0][i] += 1
+            h[1] += value; h[2] += 1
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def gauge_fn(self, name, fn):
+        self._gauge_fns[name] = fn
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        t = time.monotonic()
+        try: yield
+        finally: self.observe(name, time.monotonic() - t, **labels)
+
+    def timed(self, stage, fn):
+        """包一层同步函数, 记录 stage_seconds"""
+        def _wrap(*a, **kw):
+            with self.timer("stage_seconds", stage=stage):
+                return fn(*a, **kw)
+        return _wrap
+
+    def record_download(self, stage, extractor, nbytes, seconds):
+        self.observe("stage_seconds", seconds, stage=stage)
+        self.inc("download_bytes_total", nbytes, extractor=extractor)
+        self.inc("download_seconds_total", seconds, extractor=extractor)
+        if seconds > 0:
+            with self._lock:
+                key = ("download_speed_bytes", (("extractor", extractor),))
+                prev = self._gauges.get(key)
+                cur = nbytes / seconds
+                self._gauges[key] = cur if prev is None else prev * 0.7 + cur * 0.3  # EWMA
+
+    def snapshot(self):
+        """直方图 {(name, labels): (sum, count)} 和计数器的副本, 供基准测试前后做差"""
+        with self._lock:
+            return {k: (v[1], v[2]) for k, v in self._hist.items()}, dict(self._counters)
+
+    def render(self):
+        p = self.prefix
+        def lbl(labels, extra=()):
+            items = list(labels) + list(extra)
+            if not items: return ""
+            esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in items) + "}"
+        out, typed = [], set()
+        def head(name, kind):
+            if name not in typed:
+                typed.add(name); out.append(f"# TYPE {p}_{name} {kind}")
+        with self._lock:
+            hist = {k: (list(v[0]), v[1], v[2]) for k, v in self._hist.items()}
+            counters, gauges = dict(self._counters), dict(self._gauges)
+        for (name, labels), (buckets, total, n) in sorted(hist.items()):
+            head(name, "histogram")
+            for b, c in zip(self.BUCKETS, buckets):
+                out.append(f"{p}_{name}_bucket{lbl(labels, [('le', b)])} {c}")
+            out.append(f"{p}_{name}_bucket{lbl(labels, [('le', '+Inf')])} {n}")
+            out.append(f"{p}_{name}_sum{lbl(labels)} {total:.6f}")
+            out.append(f"{p}_{name}_count{lbl(labels)} {n}")
+        for (name, labels), v in sorted(counters.items()):
+            head(name, "counter"); out.append(f"{p}_{name}{lbl(labels)} {v}")
+        for (name, labels), v in sorted(gauges.items()):
+            head(name, "gauge"); out.append(f"{p}_{name}{lbl(labels)} {v}")
+        for name, fn in sorted(self._gauge_fns.items()):
+            try: v = fn()
+            except Exception: continue
+            head(name, "counter" if name.endswith("_total") else "gauge"); out.append(f"{p}_{name} {v}")
+        return "\n".join(out) + "\n"
+
+    def serve(self, handler, head):
+        body = self.render().encode("utf-8")
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+        if not head: handler.wfile.write(body)
+
+
+class _Job:
+    """一次实际的 解析+下载+合并; 同一资源的多个请求者共享同一个 _Job"""
+    def __init__(self, key, chat):
+        self.key = key
+        self.chat = chat
+        self.task = None
+        self.t0 = time.monotonic()
+        self.cancel = threading.Event()
+        self.queued = False  # 正在调度器里排队 (/cancel 时直接取消协程)
+        self.users = set()   # 发起/加入的用户, 见 _user_key
+        self.result = None
+        self.done = False
+        self.waiters = 0
+        self._queues = []
+        self._log = collections.deque(maxlen=8)  # 最近的消息, 后加入的请求者补发 (确认提示、失败原因等)
+
+    def subscribe(self):
+        """新等待者先收到最近的消息; 任务已结束时直接收到结束标记"""
+        q = asyncio.Queue()
+        for text in self._log: q.put_nowait(text)
+        if self.done: q.put_nowait(None)
+        self._queues.append(q)
+        self.waiters += 1
+        return q
+
+    def release(self):
+        """等待者发送完毕; 返回 True 表示是最后一个"""
+        self.waiters -= 1
+        return self.waiters == 0
+
+    def emit(self, text):
+        self._log.append(text)
+        for q in self._queues: q.put_nowait(text)
+
+    def finish(self):
+        self.done = True
+        for q in self._queues: q.put_nowait(None)
+
+
+class _QueueFull(Exception):
+    pass
+
+
+class _Cancelled(Exception):
+    pass
+
+
+class _Scheduler:
+    """下载准入: 全局并发上限 + 每个会话并发上限; 等待者按 (优先级, 先后) 出队,
+    被会话上限卡住的任务不挡后面其他会话的任务"""
+    def __init__(self, max_jobs, per_chat, max_queue):
+        self.max_jobs = max(1, max_jobs)
+        self.per_chat = max(1, per_chat)
+        self.max_queue = max_queue
+        self.running = 0
+        self._per = {}
+        self._waiting = []  # [(prio, seq, chat, future)]
+        self._seq = itertools.count()
+
+    @property
+    def depth(self):
+        return len(self._waiting)
+
+    async def acquire(self, chat, prio, on_queued=None):
+        """拿到名额后返回; 返回值表示是否排过队"""
+        if self.max_queue and len(self._waiting) >= self.max_queue:
+            raise _QueueFull()
+        fut = asyncio.get_running_loop().create_future()
+        entry = (prio, next(self._seq), chat, fut)
+        self._waiting.append(entry)
+        self._dispatch()
+        if fut.done(): return False
+        if on_queued: on_queued(sorted(self._waiting).index(entry) + 1)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if entry in self._waiting: self._waiting.remove(entry)
+            elif not fut.cancelled(): self.release(chat)
+            raise
+        return True
+
+    def release(self, chat):
+        self.running -= 1
+        self._per[chat] -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        for entry in sorted(self._waiting):
+            if self.running >= self.max_jobs: break
+            prio, _, chat, fut = entry
+            if self._per.get(chat, 0) >= self.per_chat: continue
+            self._waiting.remove(entry)
+            self.running += 1
+            self._per[chat] = self._per.get(chat, 0) + 1
+            fut.set_result(None)
+
+
+class _YdlPool:
+    """按基础选项分档复用 YoutubeDL 实例, 省掉每次初始化 extractor、解析 cookie 文件;
+    cookie 只解析一次, 文件 mtime 变化时重新加载并淘汰挂着旧 cookie 的实例。
+    实例同一时间只借给一个线程; format / outtmpl / 进度回调等按次覆盖, 归还时复原"""
+    def __init__(self, cookies_path, per_key=4):
+        self.cookies_path = cookies_path
+        self.per_key = per_key
+        self.created = self.reused = 0
+        self.generation = 0  # clear() 时 +1, 归还的旧代实例直接关掉
+        self._lock = threading.Lock()
+        self._idle = {}  # 基础选项 -> [YoutubeDL]
+        self._jar = None
+        self._jar_mtime = None
+
+    def _cookiejar(self):
+        if not self.cookies_path: return None
+        try: mtime = os.path.getmtime(self.cookies_path)
+        except OSError: return self._jar
+        if mtime != self._jar_mtime:
+            self._jar = yt_dlp.cookies.load_cookies(self.cookies_path, None, None)
+            self._jar_mtime = mtime
+            self._drop_idle()
+        return self._jar
+
+    def _drop_idle(self):
+        idle, self._idle = self._idle, {}
+        for ydls in idle.values():
+            for ydl in ydls: ydl.close()
+
+    def clear(self):
+        """yt-dlp 热更新后调用, 丢弃所有旧模块创建的实例; 正借出的实例归还时按代数淘汰"""
+        with self._lock:
+            self.generation += 1
+            self._drop_idle()
+
+    @contextlib.contextmanager
+    def checkout(self, base, **overrides):
+        key = json.dumps(base, sort_keys=True, default=str)
+        with self._lock:
+            jar = self._cookiejar()
+            gen = self.generation
+            ydls = self._idle.get(key)
+            ydl = ydls.pop() if ydls else None
+        if ydl is None:
+            ydl = yt_dlp.YoutubeDL(copy.deepcopy(base))
+            if jar is not None:
+                ydl.cookiejar = jar  # 在首次请求建立 _request_director 之前替换掉 cached_property
+            ydl._pool_state = (dict(ydl.params), ydl.format_selector, jar, gen)
+            self.created += 1
+        else:
+            self.reused += 1
+        params, selector, ydl_jar, ydl_gen = ydl._pool_state
+        hooks = overrides.pop("progress_hooks", [])
+        ydl.params.update(overrides)
+        if "format" in overrides: ydl.format_selector = ydl.build_format_selector(overrides["format"])
+        if "outtmpl" in overrides: ydl._parse_outtmpl()
+        for h in hooks: ydl.add_progress_hook(h)
+        ok = False
+        try:
+            yield ydl
+            ok = True
+        finally:
+            ydl.params.clear(); ydl.params.update(params)
+            ydl.format_selector = selector
+            ydl._progress_hooks.clear()
+            with self._lock:
+                ydls = self._idle.setdefault(key, [])
+                # 出过错的实例状态不可信, 不放回; 借出期间热更新过的是旧模块的实例, 也不放回
+                keep = (ok and ydl_jar is self._jar and ydl_gen == self.generation
+                        and len(ydls) < self.per_key)
+                if keep: ydls.append(ydl)
+            if not keep: ydl.close()
+
+
+class _ResultCache:
+    """成品缓存: 按 (归一化资源, 画质设置, ctype) 寻址, 超出磁盘预算按 LRU 淘汰, 索引持久化"""
+    def __init__(self, root, max_mb, logger):
+        self.root = root
+        self.budget = int(max_mb) * 1024 * 1024
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.index_path = os.path.join(root, "index.json")
+        self.hits = self.misses = 0
+        os.makedirs(root, exist_ok=True)
+        self.entries = self._load()
+
+    @staticmethod
+    def make_key(canon, fmt, ctype):
+        return hashlib.sha1(f"{canon}|{fmt}|{ctype}".encode("utf-8")).hexdigest()
+
+    def _load(self):
+        try:
+            with open(self.index_path, encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return {k: e for k, e in entries.items()
+                if os.path.isfile(os.path.join(self.root, e.get("file", "")))}
+
+    def _save(self):
+        tmp = self.index_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.entries, f, ensure_ascii=False)
+        os.replace(tmp, self.index_path)
+
+    def get(self, key):
+        """命中返回 (path, title) 并刷新访问时间, 否则 None"""
+        with self.lock:
+            e = self.entries.get(key)
+            path = os.path.join(self.root, e["file"]) if e else None
+            if not path or not os.path.isfile(path):
+                self.misses += 1
+                if e: self.entries.pop(key); self._save()
+                return None
+            self.hits += 1
+            e["atime"] = time.time()
+            self._save()
+            return path, e.get("title", "")
+
+    def put(self, key, src, title):
+        """把成品移入缓存目录, 返回新路径"""
+        name = key + os.path.splitext(src)[1]
+        dst = os.path.join(self.root, name)
+        with self.lock:
+            shutil.move(src, dst)
+            self.entries[key] = {"file": name, "size": os.path.getsize(dst),
+                                 "title": title, "atime": time.time()}
+            self._evict(keep=key)
+            self._save()
+        return dst
+
+    def _evict(self, keep=None):
+        total = sum(e["size"] for e in self.entries.values())
+        for k, e in sorted(self.entries.items(), key=lambda kv: kv[1]["atime"]):
+            if total <= self.budget: break
+            if k == keep: continue
+            try: os.remove(os.path.join(self.root, e["file"]))
+            except OSError: pass
+            total -= e["size"]
+            self.entries.pop(k)
+            self.logger.info(f"缓存淘汰: {e.get('title','')[:30]} ({e['size'] / 1024**2:.1f}MB)")
+
+
+class _Janitor:
+    """temp 目录清理: 插件产生的文件登记到持久化清单 (文件名 -> 到期时间), 由一个周期任务统一删除;
+    启动时按清单对账, 清单外的残留一律当孤儿删掉; 占用超过高水位时不等到期, 按到期先后提前淘汰"""
+    MANIFEST = "janitor.json"
+
+    def __init__(self, root, high_mb, grace, logger, skip=()):
+        self.root = root
+        self.high = int(high_mb) * 1024 * 1024
+        self.low = int(self.high * 0.8)
+        self.grace = grace  # 运行中未登记的文件超过这么久没写入才算孤儿 (下载中的文件还没登记)
+        self.logger = logger
+        self.skip = set(skip) | {self.MANIFEST, self.MANIFEST + ".tmp"}  # 不归这里管 (成品缓存目录等)
+        self.lock = threading.Lock()
+        self._sweeping = threading.Lock()
+        self.path = os.path.join(root, self.MANIFEST)
+        self.hooks = {}  # 文件名 -> (on_drop, busy), 只在进程内有效
+        self.removed = self.freed = 0
+        self.entries = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return {k: float(v) for k, v in json.load(f).items()}
+        except (OSError, ValueError, AttributeError):
+            return {}
+
+    def _save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.entries, f)
+        os.replace(tmp, self.path)
+
+    def track(self, paths, ttl, on_drop=None, busy=None):
+        """登记 ttl 秒后删除; busy() 为真时顺延, on_drop 在删除时调用 (摘 HTTP 路由等)"""
+        expire = time.time() + ttl
+        with self.lock:
+            for p in paths:
+                name = os.path.relpath(p, self.root)
+                if name.startswith(".."): continue
+                self.entries[name] = expire
+                if on_drop or busy: self.hooks[name] = (on_drop, busy)
+            self._save()
+
+    def _size(self, path):
+        if not os.path.isdir(path):
+            try: return os.path.getsize(path)
+            except OSError: return 0
+        total = 0
+        for r, _, files in os.walk(path):
+            for fn in files:
+                try: total += os.path.getsize(os.path.join(r, fn))
+                except OSError: pass
+        return total
+
+    def _mtime(self, path):
+        try: t = os.path.getmtime(path)
+        except OSError: return 0
+        if os.path.isdir(path):
+            for r, _, files in os.walk(path):
+                for fn in files:
+                    try: t = max(t, os.path.getmtime(os.path.join(r, fn)))
+                    except OSError: pass
+        return t
+
+    def _remove(self, name, why):
+        path = os.path.join(self.root, name)
+        size = self._size(path)
+        if os.path.isdir(path): shutil.rmtree(path, ignore_errors=True)
+        else:
+            try: os.remove(path)
+            except OSError: pass
+        with self.lock:
+            on_drop, _ = self.hooks.pop(name, (None, None))
+            self.entries.pop(name, None)
+            self.removed += 1; self.freed += size
+        if on_drop:
+            try: on_drop()
+            except Exception: pass
+        self.logger.info(f"清理({why}): {name} ({size / 1024**2:.1f}MB)")
+        return size
+
+    def _busy(self, name):
+        _, busy = self.hooks.get(name, (None, None))
+        try: return bool(busy and busy())
+        except Exception: return False
+
+    def sweep(self, startup=False):
+        """到期删除 + 孤儿清理 + 高水位淘汰; 并发调用时只跑一个。
+        startup=True 时没有进行中的任务, 清单外的文件不看写入时间直接删"""
+        if not self._sweeping.acquire(blocking=False): return 0
+        try:
+            now, freed = time.time(), 0
+            try: names = set(os.listdir(self.root)) - self.skip
+            except OSError: return 0
+            # 锁内只挑候选; 算大小、删除都在锁外做, track 在事件循环里同步调用, 不能陪着等磁盘
+            with self.lock:
+                for name in list(self.entries):
+                    if name not in names:
+                        self.entries.pop(name); self.hooks.pop(name, None)
+                expired = [n for n, t in self.entries.items() if t <= now]
+                orphans = names - set(self.entries)
+            for name in expired:
+                if not self._busy(name): freed += self._remove(name, "到期")
+            for name in orphans:
+                if name in self.entries: continue  # 挑完候选之后才登记上的
+                if startup or now - self._mtime(os.path.join(self.root, name)) > self.grace:
+                    freed += self._remove(name, "孤儿")
+            if self.high:
+                # 下载中 (还没登记) 的文件也算占用, 但只淘汰已登记的
+                left = set(os.listdir(self.root)) - self.skip
+                usage = sum(self._size(os.path.join(self.root, n)) for n in left)
+                if usage > self.high:
+                    with self.lock: order = sorted(self.entries, key=self.entries.get)
+                    for name in order:
+                        if usage <= self.low: break
+                        if name not in self.entries or self._busy(name): continue
+                        f = self._remove(name, "超出高水位")
+                        usage -= f; freed += f
+                    if usage > self.high:
+                        self.logger.warning(f"temp 占用 {usage / 1024**2:.0f}MB 仍超过高水位, 剩余文件都在使用中")
+            with self.lock: self._save()
+            return freed
+        finally:
+            self._sweeping.release()
+
+
+class _Tuner:
+    """按站点 (extractor, 认不出时用域名) 学习下载参数: 在 分片并发 × 分块大小 的网格上爬山,
+    每格的吞吐取进度回调测得 MB/s 的 EWMA; 没试过的相邻格子先试, 之后偶尔再探一次以跟上网络变化;
+    失败率 (EWMA) 决定重试次数和退避。学到的结果持久化, 重启后接着用"""
+    FRAGMENTS = (1, 2, 4, 8)   # concurrent_fragment_downloads (DASH/HLS 分片并发)
+    CHUNKS_MB = (0, 1, 10)     # http_chunk_size, 0 为不分块; 分块能绕开按连接限速
+    START = (2, 0)             # 初始: 4 分片, 不分块
+    MIN_BYTES = 1024 * 1024    # 太小的文件测不准, 只记成败不记吞吐
+    EXPLORE = 0.1
+
+    def __init__(self, path, logger):
+        self.path = path
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.sites = self._load()  # 站点 -> {"arms": {"fi,ci": [MB/s, 次数]}, "fail": 失败率, "last": 上次 MB/s}
+
+    def _load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.sites, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+
+    def _neighbors(self, arm):
+        fi, ci = arm
+        for d in ((-1, 0), (1, 0), (0, -1), (0, 1)):
+            n = (fi + d[0], ci + d[1])
+            if 0 <= n[0] < len(self.FRAGMENTS) and 0 <= n[1] < len(self.CHUNKS_MB): yield n
+
+    @staticmethod
+    def _best(arms):
+        if not arms: return None
+        k = max(arms, key=lambda a: arms[a][0])
+        return tuple(map(int, k.split(",")))
+
+    def pick(self, site):
+        """返回 (格子, yt-dlp 参数覆盖)"""
+        with self.lock:
+            s = self.sites.get(site) or {"arms": {}, "fail": 0.0}
+            best = self._best(s["arms"]) or self.START
+            untried = [n for n in self._neighbors(best) if f"{n[0]},{n[1]}" not in s["arms"]]
+            arm = best
+            if s["arms"] and untried: arm = untried[0]
+            elif s["arms"] and random.random() < self.EXPLORE: arm = random.choice(list(self._neighbors(best)))
+            return arm, self.params(arm, s["fail"])
+
+    def params(self, arm, fail):
+        f, c = self.FRAGMENTS[arm[0]], self.CHUNKS_MB[arm[1]]
+        retries = 3 + round(fail * 12)  # 3 ~ 15
+        base = 1 + fail * 4             # 失败越多退避越久
+        sleep = lambda n, b=base: min(b * 2 ** n, 30)
+        p = {"concurrent_fragment_downloads": f, "retries": retries, "fragment_retries": retries,
+             "retry_sleep_functions": {"http": sleep, "fragment": sleep}}
+        if c: p["http_chunk_size"] = c * 1024 * 1024
+        return p
+
+    def record(self, site, arm, ok, nbytes=0, seconds=0):
+        with self.lock:
+            s = self.sites.setdefault(site, {"arms": {}, "fail": 0.0})
+            s["fail"] = round(s["fail"] * 0.8 + (0.0 if ok else 0.2), 4)
+            if ok and nbytes >= self.MIN_BYTES and seconds > 0:
+                mbps = nbytes / seconds / 1024 / 1024
+                k = f"{arm[0]},{arm[1]}"
+                prev, n = s["arms"].get(k, (None, 0))
+                s["arms"][k] = [round(mbps if prev is None else prev * 0.7 + mbps * 0.3, 3), n + 1]
+                s["last"] = round(mbps, 3)
+            self._save()
+
+    def describe(self, site, arm=None):
+        with self.lock:
+            s = self.sites.get(site)
+            if not s: return f"{site}: 暂无数据"
+            p = self.params(arm or self._best(s["arms"]) or self.START, s["fail"])
+            best = self._best(s["arms"])
+            bmbps = s["arms"][f"{best[0]},{best[1]}"][0] if best else 0
+            return (f"{site}: 分片×{p['concurrent_fragment_downloads']} "
+                    f"分块 {p.get('http_chunk_size', 0) // 1024**2 or '无'}{'MB' if p.get('http_chunk_size') else ''} "
+                    f"重试 {p['retries']} | 本次 {s.get('last', 0):.1f}MB/s 最佳 {bmbps:.1f}MB/s "
+                    f"失败率 {s['fail']:.0%}")
+
+
+class _Progress:
+    """单个任务的下载进度: 汇总音视频各路流, 按间隔往聊天里发 百分比/速度/剩余时间;
+    已下载 + 预计剩余 超出预算时在进度回调里中止下载; 任务被 /cancel 时同样中止"""
+    def __init__(self, job, limit, planned, interval):
+        self.job = job
+        self.limit = limit        # 字节, None 为不限
+        self.planned = planned    # 流 -> 规划时估算的字节数, 还没开始的流按它算
+        self.interval = interval  # 秒, 0 为不发进度
+        self.loop = asyncio.get_running_loop()
+        self.streams = {}         # 流 -> [已下载, 总大小, 速度, 总大小是否精确]
+        self.oversize = None
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def hook(self, name):
+        def _hook(d):
+            if self.job.cancel.is_set():
+                raise yt_dlp.utils.DownloadCancelled("任务已取消")
+            st = d.get('status')
+            if st not in ('downloading', 'finished'): return
+            got = d.get('downloaded_bytes') or 0
+            total = d.get('total_bytes') or d.get('total_bytes_estimate') or 0
+            exact = bool(d.get('total_bytes')) or st == 'finished'
+            if st == 'finished': got = total = total or got
+            with self._lock:
+                self.streams[name] = [got, total, d.get('speed') or 0 if st == 'downloading' else 0, exact]
+                msg = self._check()
+            if self.oversize:
+                raise yt_dlp.utils.DownloadCancelled(self.oversize)
+            if msg: self.loop.call_soon_threadsafe(self.job.emit, msg)
+        return _hook
+
+    def _check(self):
+        names = set(self.planned) | set(self.streams)
+        got = sum(s[0] for s in self.streams.values())
+        expect = sum(max(self.streams[n][0], self.streams[n][1]) if n in self.streams
+                     else self.planned.get(n, 0) for n in names)
+        if self.limit:
+            # 估算值 (分片下载常见) 会抖, 留 10% 余量; 实际下载量超了则无条件中止
+            exact = all(s[3] for s in self.streams.values())
+            if got > self.limit or expect > self.limit * (1 if exact else 1.1):
+                self.oversize = (f"❌ 文件超出上限: 已下载 {got / 1024**2:.1f}MB, "
+                                 f"预计 {expect / 1024**2:.1f}MB > {self.limit / 1024**2:.0f}MB")
+                return None
+        now = time.monotonic()
+        if not self.interval or now - self._last < self.interval or not expect: return None
+        self._last = now
+        speed = sum(s[2] for s in self.streams.values())
+        eta = (expect - got) / speed if speed else None
+        return (f"⬇️ {min(got / expect, 1) * 100:.0f}% ({got / 1024**2:.1f}/{expect / 1024**2:.1f}MB) "
+                f"{speed / 1024**2:.1f}MB/s 剩余 "
+                + (f"{int(eta) // 60}:{int(eta) % 60:02d}" if eta is not None else "?"))